@@ -1,14 +1,40 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import os
 from dotenv import load_dotenv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import mimetypes
 import uuid
 import json
+import time
+import threading
 
 # 環境変数を読み込み
 load_dotenv()
 
+MB = 1024 * 1024
+
+# 一括アップロードで同時にアップロードするファイル数
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', '8'))
+# 1ファイルあたりの転送設定（この大きさを超えるファイルはマルチパートで分割し、並列に送る）
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD_MB', '8')) * MB
+S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', '8')) * MB
+S3_TRANSFER_THREADS = int(os.getenv('S3_TRANSFER_THREADS', '4'))
+
+# 処理一覧でメタデータを同時に取得する数
+S3_LIST_CONCURRENCY = int(os.getenv('S3_LIST_CONCURRENCY', '16'))
+# 処理一覧のマニフェスト（全処理のメタデータをまとめた1オブジェクト）を使うか（省略時は使わない）。
+# 他のクライアントがバケットに書き込む場合は内容が古くなるため、S3_MANIFEST_MAX_AGE 秒より古いものは使わずに一覧し直す
+S3_PROCESS_MANIFEST = os.getenv('S3_PROCESS_MANIFEST', 'false').lower() in ('1', 'true', 'yes')
+S3_MANIFEST_MAX_AGE = float(os.getenv('S3_MANIFEST_MAX_AGE', '300'))
+PROCESS_MANIFEST_KEY = '_manifest/processes.json'
+# 処理ディレクトリ内のファイル一覧をキャッシュする秒数（0 でキャッシュしない）
+S3_LISTING_CACHE_TTL = float(os.getenv('S3_LISTING_CACHE_TTL', '30'))
+
+
 class S3ImageUploader:
     def __init__(self):
         """S3クライアントを初期化"""
@@ -16,10 +42,24 @@ class S3ImageUploader:
             's3',
             aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
             aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_REGION', 'ap-northeast-1')
+            region_name=os.getenv('AWS_REGION', 'ap-northeast-1'),
+            # 並列アップロードで接続が足りなくならないよう、接続プールを同時転送数に合わせる
+            config=Config(max_pool_connections=max(10, S3_MAX_CONCURRENCY * S3_TRANSFER_THREADS))
         )
         self.bucket_name = os.getenv('S3_BUCKET_NAME')
         self.region = os.getenv('AWS_REGION', 'ap-northeast-1')
+        # すべてのアップロードで共有する転送設定
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=S3_TRANSFER_THREADS,
+            use_threads=True
+        )
+        # マニフェストの読み書きを同じプロセス内で直列化する
+        self._manifest_lock = threading.RLock()
+        # プレフィックスごとのファイル一覧のキャッシュ {prefix: (期限, ファイル情報のリスト)}
+        self._listing_cache = {}
+        self._listing_lock = threading.Lock()
         
     def create_process_directory(self, process_name=None):
         """
@@ -49,6 +89,7 @@ class S3ImageUploader:
             Body=json.dumps(metadata, ensure_ascii=False, indent=2),
             ContentType='application/json'
         )
+        self._update_manifest(add=metadata)
         
         print(f"処理ディレクトリを作成しました: {process_uuid}")
         print(f"処理名: {process_name or 'unnamed_process'}")
@@ -68,8 +109,10 @@ class S3ImageUploader:
             dict: アップロード結果の詳細情報
         """
         try:
-            # ファイルが存在するか確認
-            if not os.path.exists(file_path):
+            # ファイルが存在するか確認（サイズも同時に取得）
+            try:
+                file_size = os.stat(file_path).st_size
+            except FileNotFoundError:
                 raise FileNotFoundError(f"ファイルが見つかりません: {file_path}")
             
             # ファイル名を生成
@@ -85,9 +128,6 @@ class S3ImageUploader:
             if content_type is None:
                 content_type = 'application/octet-stream'
             
-            # ファイルサイズを取得
-            file_size = os.path.getsize(file_path)
-            
             # S3にアップロード
             with open(file_path, 'rb') as file:
                 self.s3_client.upload_fileobj(
@@ -102,8 +142,10 @@ class S3ImageUploader:
                             'original-filename': file_name,
                             'upload-timestamp': timestamp
                         }
-                    }
+                    },
+                    Config=self.transfer_config
                 )
+            self._invalidate_listing(process_uuid)
             
             # 公開URLを生成
             public_url = f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{s3_key}"
@@ -181,10 +223,11 @@ class S3ImageUploader:
             list: アップロードされた画像のS3パスのリスト
         """
         uploaded_paths = []
-        for file_path in file_paths:
-            s3_path = self.upload_card_image(process_uuid, file_path)
-            if s3_path:
-                uploaded_paths.append(s3_path)
+        for result in self._upload_many(process_uuid, file_paths, 'images/card'):
+            if result['success']:
+                uploaded_paths.append(result['s3_key'])
+            else:
+                print(f"カード画像のアップロードに失敗: {result['error']}")
         return uploaded_paths
     
     def upload_multiple_add_images(self, process_uuid, file_paths):
@@ -199,10 +242,11 @@ class S3ImageUploader:
             list: アップロードされた画像のS3パスのリスト
         """
         uploaded_paths = []
-        for file_path in file_paths:
-            s3_path = self.upload_add_image(process_uuid, file_path)
-            if s3_path:
-                uploaded_paths.append(s3_path)
+        for result in self._upload_many(process_uuid, file_paths, 'images/add'):
+            if result['success']:
+                uploaded_paths.append(result['s3_key'])
+            else:
+                print(f"追加画像のアップロードに失敗: {result['error']}")
         return uploaded_paths
     
     def upload_multiple_to_process(self, process_uuid, file_paths, subfolder='images'):
@@ -225,8 +269,7 @@ class S3ImageUploader:
             'files': []
         }
         
-        for file_path in file_paths:
-            result = self.upload_to_process(process_uuid, file_path, subfolder)
+        for result in self._upload_many(process_uuid, file_paths, subfolder):
             results['files'].append(result)
             
             if result['success']:
@@ -234,11 +277,27 @@ class S3ImageUploader:
             else:
                 results['failed_uploads'] += 1
         
-        # サマリーをS3に保存
+        # サマリーをS3に保存（全ファイルの完了後に1回だけ）
         self._save_upload_summary(process_uuid, results)
         
         return results
     
+    def _upload_many(self, process_uuid, file_paths, subfolder):
+        """
+        複数ファイルを最大 S3_MAX_CONCURRENCY 件ずつ並列にアップロード
+        
+        Returns:
+            list: upload_to_process の結果のリスト（file_paths と同じ順）
+        """
+        if not file_paths:
+            return []
+        workers = min(S3_MAX_CONCURRENCY, len(file_paths))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='s3-upload') as executor:
+            return list(executor.map(
+                lambda file_path: self.upload_to_process(process_uuid, file_path, subfolder),
+                file_paths
+            ))
+    
     def _save_upload_summary(self, process_uuid, results):
         """アップロード結果のサマリーをS3に保存"""
         summary_key = f"{process_uuid}/upload_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
@@ -249,22 +308,18 @@ class S3ImageUploader:
             ContentType='application/json'
         )
     
-    def get_process_contents(self, process_uuid):
+    def get_process_contents(self, process_uuid, include_metadata=False):
         """
         特定の処理ディレクトリの内容を取得
         
         Args:
             process_uuid (str): 処理のUUID
+            include_metadata (bool): metadata.json をダウンロードして 'metadata' に入れるか
             
         Returns:
             dict: ディレクトリ内のファイル情報
         """
         try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix=f"{process_uuid}/"
-            )
-            
             contents = {
                 'process_uuid': process_uuid,
                 'metadata': None,
@@ -277,31 +332,24 @@ class S3ImageUploader:
                 'other': []
             }
             
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    key = obj['Key']
-                    file_info = {
-                        'key': key,
-                        'size': obj['Size'],
-                        'last_modified': obj['LastModified'].isoformat(),
-                        'url': f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key}"
-                    }
-                    
-                    # ファイルを分類
-                    if key.endswith('metadata.json'):
-                        # メタデータを読み込み
-                        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
-                        contents['metadata'] = json.loads(response['Body'].read())
-                    elif '/images/card/' in key:
-                        contents['images']['card'].append(file_info)
-                    elif '/images/add/' in key:
-                        contents['images']['add'].append(file_info)
-                    elif '/images/' in key:
-                        contents['images']['other'].append(file_info)
-                    elif '/data/' in key:
-                        contents['data'].append(file_info)
-                    else:
-                        contents['other'].append(file_info)
+            for file_info in self._list_objects(f"{process_uuid}/"):
+                key = file_info['key']
+                
+                # ファイルを分類
+                if key.endswith('metadata.json'):
+                    # メタデータは必要なときだけ読み込む
+                    if include_metadata:
+                        contents['metadata'] = self.get_process_metadata(process_uuid)
+                elif '/images/card/' in key:
+                    contents['images']['card'].append(file_info)
+                elif '/images/add/' in key:
+                    contents['images']['add'].append(file_info)
+                elif '/images/' in key:
+                    contents['images']['other'].append(file_info)
+                elif '/data/' in key:
+                    contents['data'].append(file_info)
+                else:
+                    contents['other'].append(file_info)
             
             return contents
             
@@ -309,6 +357,18 @@ class S3ImageUploader:
             print(f"取得エラー: {str(e)}")
             raise
     
+    def get_process_metadata(self, process_uuid):
+        """
+        特定の処理のメタデータ（metadata.json）を取得
+        
+        Args:
+            process_uuid (str): 処理のUUID
+            
+        Returns:
+            dict: メタデータ（存在しない場合は None）
+        """
+        return self._read_json(f"{process_uuid}/metadata.json")
+    
     def get_card_images(self, process_uuid):
         """
         特定の処理のカード画像一覧を取得
@@ -319,8 +379,7 @@ class S3ImageUploader:
         Returns:
             list: カード画像のS3パスのリスト
         """
-        contents = self.get_process_contents(process_uuid)
-        return [img['key'] for img in contents['images']['card']]
+        return [img['key'] for img in self._list_objects(f"{process_uuid}/images/card/")]
     
     def get_add_images(self, process_uuid):
         """
@@ -332,8 +391,46 @@ class S3ImageUploader:
         Returns:
             list: 追加画像のS3パスのリスト
         """
-        contents = self.get_process_contents(process_uuid)
-        return [img['key'] for img in contents['images']['add']]
+        return [img['key'] for img in self._list_objects(f"{process_uuid}/images/add/")]
+    
+    def _list_objects(self, prefix):
+        """
+        プレフィックス配下のファイル情報をすべて取得（ページングあり）
+        
+        結果は S3_LISTING_CACHE_TTL 秒キャッシュする。処理ディレクトリ全体の一覧が
+        キャッシュにあれば、サブプレフィックスの一覧はそこから絞り込んで返す。
+        """
+        process_prefix = prefix.split('/')[0] + '/'
+        now = time.monotonic()
+        with self._listing_lock:
+            for cached_prefix in (prefix, process_prefix):
+                entry = self._listing_cache.get(cached_prefix)
+                if entry and entry[0] > now:
+                    return [info for info in entry[1] if info['key'].startswith(prefix)]
+        
+        objects = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                objects.append({
+                    'key': key,
+                    'size': obj['Size'],
+                    'last_modified': obj['LastModified'].isoformat(),
+                    'url': f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key}"
+                })
+        
+        if S3_LISTING_CACHE_TTL > 0:
+            with self._listing_lock:
+                self._listing_cache[prefix] = (time.monotonic() + S3_LISTING_CACHE_TTL, objects)
+        return list(objects)
+    
+    def _invalidate_listing(self, process_uuid):
+        """処理ディレクトリのファイル一覧のキャッシュを破棄"""
+        process_prefix = f"{process_uuid}/"
+        with self._listing_lock:
+            for prefix in [p for p in self._listing_cache if p.startswith(process_prefix)]:
+                del self._listing_cache[prefix]
     
     def delete_process_directory(self, process_uuid):
         """
@@ -343,23 +440,20 @@ class S3ImageUploader:
             process_uuid (str): 削除する処理のUUID
         """
         try:
-            # ディレクトリ内の全オブジェクトを取得
-            objects_to_delete = []
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix=f"{process_uuid}/"
-            )
+            # ディレクトリ内の全オブジェクトを取得（キャッシュを使わずに一覧する）
+            self._invalidate_listing(process_uuid)
+            objects_to_delete = [{'Key': info['key']} for info in self._list_objects(f"{process_uuid}/")]
+            self._invalidate_listing(process_uuid)
             
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    objects_to_delete.append({'Key': obj['Key']})
-                
-                # バッチ削除
-                self.s3_client.delete_objects(
-                    Bucket=self.bucket_name,
-                    Delete={'Objects': objects_to_delete}
-                )
+            if objects_to_delete:
+                # バッチ削除（1回のリクエストで削除できるのは1000件まで）
+                for i in range(0, len(objects_to_delete), 1000):
+                    self.s3_client.delete_objects(
+                        Bucket=self.bucket_name,
+                        Delete={'Objects': objects_to_delete[i:i + 1000]}
+                    )
                 
+                self._update_manifest(remove=process_uuid)
                 print(f"処理ディレクトリを削除しました: {process_uuid}")
                 print(f"削除されたファイル数: {len(objects_to_delete)}")
             else:
@@ -369,47 +463,149 @@ class S3ImageUploader:
             print(f"削除エラー: {str(e)}")
             raise
     
-    def list_all_processes(self):
+    def list_all_processes(self, use_manifest=S3_PROCESS_MANIFEST):
         """
         すべての処理ディレクトリの一覧を取得
         
+        Args:
+            use_manifest (bool): マニフェストがあればそれを使う（GET 1回で一覧を返す）
+        
         Returns:
             list: 処理情報のリスト
         """
         try:
-            # ルートレベルのディレクトリを取得
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name,
-                Delimiter='/'
-            )
-            
-            processes = []
-            
-            if 'CommonPrefixes' in response:
-                for prefix in response['CommonPrefixes']:
-                    process_uuid = prefix['Prefix'].rstrip('/')
-                    
-                    # メタデータを取得
-                    try:
-                        metadata_response = self.s3_client.get_object(
-                            Bucket=self.bucket_name,
-                            Key=f"{process_uuid}/metadata.json"
-                        )
-                        metadata = json.loads(metadata_response['Body'].read())
-                        processes.append(metadata)
-                    except:
-                        # メタデータがない場合は基本情報のみ
-                        processes.append({
-                            'uuid': process_uuid,
-                            'process_name': 'unknown',
-                            'created_at': 'unknown'
-                        })
-            
-            return processes
-            
+            return list(self.iter_processes(use_manifest=use_manifest))
         except Exception as e:
             print(f"一覧取得エラー: {str(e)}")
             raise
+    
+    def iter_processes(self, use_manifest=S3_PROCESS_MANIFEST):
+        """
+        処理ディレクトリを1件ずつ返すジェネレータ
+        
+        S3_MANIFEST_MAX_AGE 秒以内に一覧して作成したマニフェストがあればその内容を返す。なければバケットのルートをページ単位で一覧し、
+        各ページのメタデータを最大 S3_LIST_CONCURRENCY 件ずつ並列に取得しながら返す。
+        最後まで一覧した場合は、次回のためにマニフェストを作成する。
+        
+        Args:
+            use_manifest (bool): マニフェストを使うか
+            
+        Yields:
+            dict: 処理のメタデータ（metadata.json がない処理は基本情報のみ）
+        """
+        if use_manifest:
+            manifest = self._read_json(PROCESS_MANIFEST_KEY)
+            if manifest is not None and self._is_manifest_fresh(manifest):
+                yield from manifest.get('processes', {}).values()
+                return
+        
+        scanned_at = datetime.now().isoformat()
+        processes = {}
+        for metadata in self._scan_processes():
+            processes[metadata['uuid']] = metadata
+            yield metadata
+        
+        if use_manifest:
+            self._write_manifest(processes, scanned_at=scanned_at)
+    
+    def rebuild_manifest(self):
+        """
+        バケットを一覧し直してマニフェストを作り直す（他の経路で追加・削除された処理を反映する）
+        
+        Returns:
+            int: マニフェストに記録した処理の数
+        """
+        processes = {metadata['uuid']: metadata for metadata in self._scan_processes()}
+        self._write_manifest(processes)
+        return len(processes)
+    
+    def _is_manifest_fresh(self, manifest):
+        """マニフェストが S3_MANIFEST_MAX_AGE 秒以内にバケットを一覧して作成されたものか"""
+        try:
+            scanned_at = datetime.fromisoformat(manifest['scanned_at'])
+        except (KeyError, TypeError, ValueError):
+            return False
+        return (datetime.now() - scanned_at).total_seconds() <= S3_MANIFEST_MAX_AGE
+    
+    def _scan_processes(self):
+        """ルートレベルのディレクトリをページ単位で一覧し、メタデータを並列に取得して返す"""
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        manifest_prefix = PROCESS_MANIFEST_KEY.split('/')[0] + '/'
+        
+        with ThreadPoolExecutor(max_workers=S3_LIST_CONCURRENCY, thread_name_prefix='s3-list') as executor:
+            for page in paginator.paginate(Bucket=self.bucket_name, Delimiter='/'):
+                process_uuids = [
+                    prefix['Prefix'].rstrip('/')
+                    for prefix in page.get('CommonPrefixes', [])
+                    if prefix['Prefix'] != manifest_prefix
+                ]
+                # ページ内の順序を保ったまま返す
+                yield from executor.map(self._get_process_metadata, process_uuids)
+    
+    def _get_process_metadata(self, process_uuid):
+        """処理のメタデータを取得（ない・読めない場合は基本情報のみ）"""
+        try:
+            metadata = self._read_json(f"{process_uuid}/metadata.json")
+        except (ClientError, ValueError):
+            metadata = None
+        if metadata is None:
+            return {
+                'uuid': process_uuid,
+                'process_name': 'unknown',
+                'created_at': 'unknown'
+            }
+        return metadata
+    
+    def _read_json(self, key):
+        """JSONオブジェクトを読み込む。存在しない場合は None"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+    
+    def _write_manifest(self, processes, scanned_at=None):
+        """
+        マニフェストを書き込む。scanned_at はバケットを最後に一覧した日時（省略時は今）で、
+        鮮度の判定に使う（作成・削除の反映では更新しない）
+        """
+        with self._manifest_lock:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=PROCESS_MANIFEST_KEY,
+                Body=json.dumps({
+                    'updated_at': datetime.now().isoformat(),
+                    'scanned_at': scanned_at or datetime.now().isoformat(),
+                    'processes': processes
+                }, ensure_ascii=False, separators=(',', ':')),
+                ContentType='application/json'
+            )
+    
+    def _update_manifest(self, add=None, remove=None):
+        """
+        処理の作成・削除をマニフェストに反映する
+        
+        マニフェストがまだない場合は何もしない（次回の一覧で作成される）。
+        別プロセスとの同時更新で食い違った場合は rebuild_manifest で作り直す。
+        """
+        if not S3_PROCESS_MANIFEST:
+            return
+        try:
+            with self._manifest_lock:
+                manifest = self._read_json(PROCESS_MANIFEST_KEY)
+                if manifest is None:
+                    return
+                processes = manifest.get('processes', {})
+                if add is not None:
+                    processes[add['uuid']] = add
+                if remove is not None:
+                    processes.pop(remove, None)
+                self._write_manifest(processes, scanned_at=manifest.get('scanned_at'))
+        except Exception as e:
+            # マニフェストは一覧の高速化のためだけのものなので、失敗しても処理は続ける
+            print(f"マニフェスト更新エラー: {str(e)}")
 
 
 # 使用例
@@ -3,8 +3,11 @@ import json
 import os
 import re
 import traceback # For detailed error logging if needed
+import threading
 import configparser
 
+from email_cache import email_cache, prompt_fingerprint
+
 # --- 設定 ---
 config = configparser.ConfigParser()
 config.read("config.ini", encoding="utf-8")
@@ -12,6 +15,33 @@ config.read("config.ini", encoding="utf-8")
 API_KEY = config["HOST"]["GEMINI_TOKEN"]  # Gemini APIキー
 MODEL_NAME = config["HOST"]["GEMINI_MODEL"]  # 使用するGeminiモデル名
 
+# --- モデルの初期化（プロセス内で一度だけ） ---
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """
+    APIキーの設定と GenerativeModel の作成を一度だけ行い、以降は同じモデルを使い回す
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            genai.configure(api_key=API_KEY)
+            _model = genai.GenerativeModel(MODEL_NAME)
+        return _model
+
+
+def usage_to_dict(usage_metadata):
+    """
+    レスポンスの usage_metadata をトークン数の辞書にする
+    """
+    return {
+        "prompt_token_count": getattr(usage_metadata, "prompt_token_count", 0) or 0,
+        "candidates_token_count": getattr(usage_metadata, "candidates_token_count", 0) or 0,
+        "total_token_count": getattr(usage_metadata, "total_token_count", 0) or 0,
+    }
+
 
 # --- プロンプト生成関数  ---
 def build_gemini_prompt(context, recipient_details, exhibition_name="[展示会名]"):
@@ -75,7 +105,98 @@ def build_gemini_prompt(context, recipient_details, exhibition_name="[展示会
 """
     return prompt
 
+# --- 生成済みメールのキャッシュ ---
+def lead_fingerprint(context, recipient_details, exhibition_name="[展示会名]"):
+    """
+    プロンプトを組み立て、モデル名と合わせたハッシュ値（キャッシュのキー）を返す
+    """
+    return prompt_fingerprint(build_gemini_prompt(context, recipient_details, exhibition_name), MODEL_NAME)
+
+
+def lookup_cached_email(context, recipient_details, exhibition_name="[展示会名]"):
+    """
+    同じプロンプトで生成済みのメールがあれば (結果の辞書, トークン使用量の辞書) を返す。なければ None。
+    キャッシュから返した分は API を呼ばないため、使用量は 0 とし saved_token_count に前回の消費量を入れる。
+    """
+    entry = email_cache.get(lead_fingerprint(context, recipient_details, exhibition_name))
+    if entry is None:
+        return None
+    usage = usage_to_dict(None)
+    usage["saved_token_count"] = entry["usage"].get("total_token_count", 0)
+    return entry["email"], usage
+
+
+def invalidate_cached_email(context, recipient_details, exhibition_name="[展示会名]"):
+    """
+    指定したリードのキャッシュを削除し、次回は生成し直す
+    """
+    return email_cache.invalidate(lead_fingerprint(context, recipient_details, exhibition_name))
+
+
 # --- メインのメール生成関数 ---
+def generate_email_with_usage(context, recipient_details, exhibition_name="[展示会名]", use_cache=True):
+    """
+    Gemini APIを1回呼び出してメールのタイトルと本文を生成し、
+    (結果の辞書, トークン使用量の辞書) を返す。API のエラーはそのまま送出する。
+    応答を JSON として読めない、または件名・本文が欠けている場合は ValueError を送出する（呼び出し側で再試行する）。
+    use_cache=True の場合は、同じプロンプトで生成済みのメールがあればそれを返す（結果は常に保存する）。
+    """
+    if use_cache:
+        cached = lookup_cached_email(context, recipient_details, exhibition_name)
+        if cached:
+            return cached
+
+    model = get_model()
+
+    # プロンプトを生成
+    prompt = build_gemini_prompt(context, recipient_details, exhibition_name)
+
+    # APIリクエストを送信
+    response = model.generate_content(prompt)
+    usage = usage_to_dict(response.usage_metadata)
+
+    # レスポンスからJSONテキストを抽出・整形
+    generated_text = response.text
+    cleaned_text = re.sub(r'^```(?:json)?\s*|\s*```$', '', generated_text.strip(), flags=re.MULTILINE | re.DOTALL)
+
+    # JSONとしてパース（解析エラーのメールを下書きやキャッシュに残さないよう、失敗は送出する）
+    try:
+        generated_json = json.loads(cleaned_text)
+    except json.JSONDecodeError as json_err:
+        print(f"Error decoding JSON from response: {json_err}")
+        print(f"Response text was: {cleaned_text}")
+        raise ValueError(f"Gemini の応答を JSON として解析できませんでした: {json_err}") from json_err
+    generated_title = generated_json.get("title") if isinstance(generated_json, dict) else None
+    generated_message_text = generated_json.get("message_text") if isinstance(generated_json, dict) else None
+    if not generated_title or not generated_message_text:
+        print(f"Response text was: {cleaned_text}")
+        raise ValueError("Gemini の応答に件名（title）または本文（message_text）がありません")
+
+    # ★修正箇所: 宛名の追加処理を削除 (AIが本文に含めるため)
+    final_body = generated_message_text.strip() # AIが生成した本文をそのまま使用
+
+    # 結果をJSON形式で整形
+    result_json = {
+        "タイトル": generated_title,
+        "本文": final_body # 署名なしの本文
+    }
+    
+    text_block = """
+    
+▼オンラインお打ち合わせのご予約（Timerex）
+(ここに予約リンクを挿入)
+すぐのお打ち合わせが難しい場合は、14日間、全機能をお試しいただける無料トライアルもございます。「試してみたい」と思われましたら、このメールにご返信ください。詳細をご案内します。 （可能であれば、直接お話しして最適な使い方を見つけられたら嬉しいです。）
+お忙しいところ恐縮ですが、ご連絡をお待ちしております。
+"""
+    
+    result_json["本文"] += text_block # 固定テキストを追加
+
+    # JSONとして読めた結果だけがここに来るので、そのままキャッシュする
+    email_cache.put(prompt_fingerprint(prompt, MODEL_NAME), result_json, usage, MODEL_NAME)
+    
+    return result_json, usage
+
+
 def generate_email_with_gemini(context, recipient_details, exhibition_name="[展示会名]"):
     """
     Gemini APIを1回呼び出してメールのタイトルと本文(JSON)を取得し、
@@ -94,56 +215,8 @@ def generate_email_with_gemini(context, recipient_details, exhibition_name="[展
         return json.dumps({"error": "APIキーが設定されていません。"}, ensure_ascii=False, indent=2), 0
 
     try:
-        # APIキーとモデルを設定
-        genai.configure(api_key=API_KEY)
-        model = genai.GenerativeModel(MODEL_NAME)
-
-        # プロンプトを生成
-        prompt = build_gemini_prompt(context, recipient_details, exhibition_name)
-
-        # APIリクエストを送信
-        response = model.generate_content(prompt)
-        usage_metadata = response.usage_metadata
-        total_tokens = usage_metadata.total_token_count if usage_metadata else 0
-
-        # レスポンスからJSONテキストを抽出・整形
-        generated_text = response.text
-        cleaned_text = re.sub(r'^```(?:json)?\s*|\s*```$', '', generated_text.strip(), flags=re.MULTILINE | re.DOTALL)
-
-        # JSONとしてパース
-        generated_json = {}
-        generated_title = "[件名抽出エラー]"
-        generated_message_text = "[本文抽出エラー]"
-        try:
-            generated_json = json.loads(cleaned_text)
-            generated_title = generated_json.get("title", generated_title)
-            generated_message_text = generated_json.get("message_text", generated_message_text)
-        except json.JSONDecodeError as json_err:
-            print(f"Error decoding JSON from response: {json_err}")
-            print(f"Response text was: {cleaned_text}")
-            generated_title = "[件名JSON解析エラー]"
-            generated_message_text = f"[本文JSON解析エラー]\nAPI応答:\n{cleaned_text}"
-
-        # ★修正箇所: 宛名の追加処理を削除 (AIが本文に含めるため)
-        final_body = generated_message_text.strip() # AIが生成した本文をそのまま使用
-
-        # 結果をJSON形式で整形
-        result_json = {
-            "タイトル": generated_title,
-            "本文": final_body # 署名なしの本文
-        }
-        
-        text_block = """
-    
-▼オンラインお打ち合わせのご予約（Timerex）
-(ここに予約リンクを挿入)
-すぐのお打ち合わせが難しい場合は、14日間、全機能をお試しいただける無料トライアルもございます。「試してみたい」と思われましたら、このメールにご返信ください。詳細をご案内します。 （可能であれば、直接お話しして最適な使い方を見つけられたら嬉しいです。）
-お忙しいところ恐縮ですが、ご連絡をお待ちしております。
-"""
-        
-        result_json["本文"] += text_block # 固定テキストを追加
-        
-        return result_json, total_tokens
+        result_json, usage = generate_email_with_usage(context, recipient_details, exhibition_name)
+        return result_json, usage["total_token_count"]
 
     except Exception as e:
         print(f"[ERROR] Gemini API の呼び出しまたは処理中にエラーが発生しました:", e)
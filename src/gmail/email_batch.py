@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import random
+import threading
+import configparser
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import create_gmail
+from email_cache import email_cache
+
+# --- 設定 ---
+config = configparser.ConfigParser()
+config.read("config.ini", encoding="utf-8")
+
+GEMINI_CONCURRENCY = int(config["HOST"].get("GEMINI_CONCURRENCY", "4"))  # 同時に生成する件数
+GEMINI_QPM = float(config["HOST"].get("GEMINI_QPM", "60"))  # 1分あたりのリクエスト数の上限
+GEMINI_MAX_RETRIES = int(config["HOST"].get("GEMINI_MAX_RETRIES", "3"))
+
+# 生成済みメールの記録（1件ごとに追記し、再実行時は生成済みのリードを飛ばす）
+EMAIL_CHECKPOINT_PATH = os.path.join('cache', 'email_drafts.jsonl')
+
+
+class QpmLimiter:
+    """
+    1分あたりのリクエスト数を守るため、呼び出しの間隔を 60/qpm 秒以上あける（スレッドセーフ）
+    """
+    def __init__(self, qpm: float):
+        self.interval = 60.0 / qpm if qpm > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def lead_key(recipient_details: dict) -> str:
+    """
+    リードの識別子。ページが編集されていれば別のリードとして生成し直す
+    """
+    return f"{recipient_details.get('page_id')}:{recipient_details.get('last_edited_time', '')}"
+
+
+class EmailBatch:
+    """
+    複数リードのメール文面を、同時実行数と1分あたりのリクエスト数を制限しながら並列に生成する。
+    生成できたものは EMAIL_CHECKPOINT_PATH に1件ずつ記録し、再実行時には生成し直さない。
+    """
+    def __init__(self, exhibition_name="[展示会名]", concurrency=GEMINI_CONCURRENCY, qpm=GEMINI_QPM,
+                 checkpoint_path=EMAIL_CHECKPOINT_PATH):
+        self.exhibition_name = exhibition_name
+        self.concurrency = max(1, concurrency)
+        self.limiter = QpmLimiter(qpm)
+        self.checkpoint_path = checkpoint_path
+        self._checkpoint_lock = threading.Lock()
+        self.records = self._read_checkpoint()
+
+    def run(self, leads):
+        """
+        leads: (context, recipient_details) の反復可能オブジェクト（ジェネレータでもよい）
+        今回新たに生成したメールの記録のリストを返す
+        """
+        generated = []
+        skipped, failed = 0, 0
+        # 先読みしすぎないよう、投入済みで未完了の件数を制限する
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        results_lock = threading.Lock()
+
+        def work(context, recipient_details):
+            nonlocal failed
+            try:
+                record = self._generate(context, recipient_details)
+                with results_lock:
+                    if record:
+                        generated.append(record)
+                    else:
+                        failed += 1
+            finally:
+                slots.release()
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="gemini") as executor:
+            for context, recipient_details in leads:
+                if lead_key(recipient_details) in self.records:
+                    skipped += 1
+                    continue
+                slots.acquire()
+                futures.append(executor.submit(work, context, recipient_details))
+
+        # 記録の保存などで例外になったものも失敗として数える（黙って捨てない）
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"[メール生成] 処理中にエラーが発生しました: {e}")
+                failed += 1
+
+        tokens = sum(r["usage"]["total_token_count"] for r in generated)
+        saved = sum(r["usage"].get("saved_token_count", 0) for r in generated)
+        print(f"[メール生成] 生成 {len(generated)} 件 / 生成済み {skipped} 件 / 失敗 {failed} 件（合計 {tokens} トークン）")
+        print(f"[メール生成] キャッシュ利用 {email_cache.stats()['hits']} 件（節約 {saved} トークン）")
+        return generated
+
+    def latest_records(self):
+        """
+        リード（page_id）ごとに、最後に生成したメールの記録を返す
+        """
+        latest = {}
+        for record in self.records.values():
+            current = latest.get(record["page_id"])
+            if current is None or record["generated_at"] > current["generated_at"]:
+                latest[record["page_id"]] = record
+        return list(latest.values())
+
+    def _generate(self, context, recipient_details):
+        """
+        1件分のメールを生成して記録する。再試行しても失敗した場合は None を返す
+        """
+        name = recipient_details.get('担当者氏名', '')
+        # 同じプロンプトで生成済みなら API を呼ばない（リクエスト数の上限にも数えない）
+        cached = create_gmail.lookup_cached_email(context, recipient_details, self.exhibition_name)
+        for attempt in range(1, GEMINI_MAX_RETRIES + 1):
+            if cached:
+                email, usage = cached
+                break
+            self.limiter.acquire()
+            try:
+                email, usage = create_gmail.generate_email_with_usage(
+                    context, recipient_details, self.exhibition_name, use_cache=False
+                )
+                break
+            except Exception as e:
+                print(f"[メール生成] {name} 様 試行 {attempt}/{GEMINI_MAX_RETRIES} 失敗: {e}")
+                if attempt == GEMINI_MAX_RETRIES:
+                    return None
+                # 指数バックオフ（full jitter）
+                time.sleep(random.uniform(0, min(60.0, 2 ** attempt)))
+
+        record = {
+            "lead_key": lead_key(recipient_details),
+            "page_id": recipient_details.get("page_id"),
+            "recipient": recipient_details,
+            "email": email,
+            "usage": usage,
+            "generated_at": datetime.now().isoformat(),
+        }
+        self._append_checkpoint(record)
+        print(f"[メール生成] {name} 様: {usage['total_token_count']} トークン")
+        return record
+
+    # --- チェックポイント ---
+    def _read_checkpoint(self) -> dict:
+        records = {}
+        if not os.path.exists(self.checkpoint_path):
+            return records
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で落ちた最終行は無視する
+                    continue
+                records[entry["lead_key"]] = entry
+        return records
+
+    def _append_checkpoint(self, record: dict):
+        with self._checkpoint_lock:
+            os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.records[record["lead_key"]] = record
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# 生成済みメールのキャッシュ（プロンプトとモデル名が同じなら前回の結果を使う）
+EMAIL_CACHE_PATH = os.path.join('cache', 'email_cache.json')
+
+
+def prompt_fingerprint(prompt: str, model_name: str) -> str:
+    """
+    プロンプト本文とモデル名から SHA-256 のハッシュ値を求める（キャッシュのキー）
+    """
+    h = hashlib.sha256()
+    h.update(model_name.encode("utf-8"))
+    h.update(b"\0")
+    h.update(prompt.encode("utf-8"))
+    return h.hexdigest()
+
+
+class EmailCache:
+    """
+    プロンプトのハッシュ値をキーに、生成したメール（タイトル・本文）とトークン数を保存するキャッシュ。
+    JSONファイルに保存して次回の実行でも使い、今回の実行で節約できたトークン数を集計する。
+    """
+    def __init__(self, path: str = EMAIL_CACHE_PATH):
+        self.path = path
+        self._entries = {}
+        self._hits = 0
+        self._misses = 0
+        self._tokens_saved = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def get(self, fingerprint: str):
+        """
+        キャッシュされたエントリ（email, usage）を返す。なければ None
+        """
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._tokens_saved += entry.get("usage", {}).get("total_token_count", 0)
+            return dict(entry)
+
+    def put(self, fingerprint: str, email: dict, usage: dict, model_name: str):
+        with self._lock:
+            self._entries[fingerprint] = {
+                "email": email,
+                "usage": usage,
+                "model": model_name,
+                "created_at": time.time(),
+            }
+            self._save()
+
+    def invalidate(self, fingerprint: str) -> bool:
+        """
+        指定したエントリを削除する。削除した場合は True
+        """
+        with self._lock:
+            if self._entries.pop(fingerprint, None) is None:
+                return False
+            self._save()
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._save()
+
+    def stats(self) -> dict:
+        """
+        今回の実行でのヒット数と節約できたトークン数
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "tokens_saved": self._tokens_saved,
+            }
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"[キャッシュ] メールキャッシュの読み込みに失敗しました（空で開始します）: {e}")
+            self._entries = {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, self.path)
+
+
+# グローバルインスタンス
+email_cache = EmailCache()
@@ -1,9 +1,21 @@
-import configParser
 import requests
 import configparser
 import os
 import re
+import json
+import sqlite3
+from datetime import datetime
 
+# --- 設定 ---
+config = configparser.ConfigParser()
+config.read("config.ini", encoding="utf-8")
+
+NOTION_API_TOKEN = config["HOST"]["NOTION_API_TOKEN"]
+NOTION_VERSION = config["HOST"]["NOTION_VERSION"]
+DATABASE_ID = config["HOST"]["DATABASE_ID"]
+
+# 取得済みページのローカルキャッシュ（次回以降は前回以降に編集されたページだけを取得する）
+NOTION_CACHE_PATH = os.path.join('cache', 'notion_pages.sqlite3')
 
 # 共通ヘッダーの設定
 headers = {
@@ -12,45 +24,204 @@ headers = {
     "Content-Type": "application/json"
 }
 
+# 接続を使い回すためのセッション
+session = requests.Session()
+session.headers.update(headers)
 
-def query_database_all_position():
+# 指定の役職に一致する条件をORで連結
+POSITION_FILTER = {
+    "or": [
+        {"property": "役職", "multi_select": {"contains": "部長"}},
+        {"property": "役職", "multi_select": {"contains": "本部長"}},
+        {"property": "役職", "multi_select": {"contains": "事務部長"}},
+        {"property": "役職", "multi_select": {"contains": "課長"}},
+        {"property": "役職", "multi_select": {"contains": "役員・理事"}},
+        {"property": "役職", "multi_select": {"contains": "代表取締役"}},
+        {"property": "役職", "multi_select": {"contains": "マネージャ"}},
+        {"property": "役職", "multi_select": {"contains": "副部長"}},
+        {"property": "役職", "multi_select": {"contains": "課長代理"}}
+    ]
+}
+
+
+def iter_database_pages(payload, start_cursor=None, on_batch=None):
     """
-    Notion データベース内の既存ページを全てクエリして取得する
-    ただし、役職フィールドが指定のものに一致するデータのみを対象とする
+    データベースのクエリ結果を1ページずつ返すジェネレータ（has_more / next_cursor でページング）
+    on_batch を指定すると、1回のクエリ分を返し終えるたびに on_batch(next_cursor) を呼ぶ
     """
     url = f"https://api.notion.com/v1/databases/{DATABASE_ID}/query"
-    all_results = []
-    # 指定の役職に一致する条件をORで連結
-    payload = {
-        "filter": {
-            "or": [
-                {"property": "役職", "multi_select": {"contains": "部長"}},
-                {"property": "役職", "multi_select": {"contains": "本部長"}},
-                {"property": "役職", "multi_select": {"contains": "事務部長"}},
-                {"property": "役職", "multi_select": {"contains": "課長"}},
-                {"property": "役職", "multi_select": {"contains": "役員・理事"}},
-                {"property": "役職", "multi_select": {"contains": "代表取締役"}},
-                {"property": "役職", "multi_select": {"contains": "マネージャ"}},
-                {"property": "役職", "multi_select": {"contains": "副部長"}},
-                {"property": "役職", "multi_select": {"contains": "課長代理"}}
-            ]
-        }
-    }
+    payload = dict(payload)
+    if start_cursor:
+        payload['start_cursor'] = start_cursor
 
     while True:
-        response = requests.post(url, headers=headers, json=payload)
+        response = session.post(url, json=payload)
         response.raise_for_status()
         data = response.json()
-        
-        # 今回のクエリ結果を蓄積
-        all_results.extend(data['results'])
-        
+
+        for page in data['results']:
+            yield page
+
+        next_cursor = data.get('next_cursor') if data.get('has_more') else None
+        if on_batch:
+            on_batch(next_cursor)
+
         # もし次のページがなければ終了
-        if not data.get('has_more'):
+        if not next_cursor:
             break
-        
+
         # 次のページがある場合は、start_cursor に next_cursor を追加
-        payload['start_cursor'] = data.get('next_cursor')
-    
-    
-    return all_results
\ No newline at end of file
+        payload['start_cursor'] = next_cursor
+
+
+def query_database_all_position():
+    """
+    Notion データベース内の既存ページを全てクエリして取得する
+    ただし、役職フィールドが指定のものに一致するデータのみを対象とする
+    """
+    return list(iter_database_pages({"filter": POSITION_FILTER}))
+
+
+class NotionPageCache:
+    """
+    取得済みページを SQLite に保存し、同期の進み具合（最終編集日時の基準値・カーソル）を記録する
+    """
+    def __init__(self, path: str = NOTION_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    page_id TEXT PRIMARY KEY,
+                    last_edited_time TEXT,
+                    data TEXT,
+                    synced_at TEXT
+                );
+                CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT);
+            """)
+
+    def get_state(self, key):
+        row = self.conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, **values):
+        with self.conn:
+            for key, value in values.items():
+                if value is None:
+                    self.conn.execute("DELETE FROM sync_state WHERE key = ?", (key,))
+                else:
+                    self.conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+    def last_edited_time(self, page_id):
+        row = self.conn.execute("SELECT last_edited_time FROM pages WHERE page_id = ?", (page_id,)).fetchone()
+        return row[0] if row else None
+
+    def save(self, page):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (page_id, last_edited_time, data, synced_at) VALUES (?, ?, ?, ?)",
+                (page["id"], page.get("last_edited_time"), json.dumps(page, ensure_ascii=False), datetime.now().isoformat()),
+            )
+
+    def pages(self):
+        for (data,) in self.conn.execute("SELECT data FROM pages ORDER BY last_edited_time"):
+            yield json.loads(data)
+
+
+def sync_database_incremental(cache=None):
+    """
+    前回の同期以降に作成・編集されたページだけを取得して返すジェネレータ。
+    返したページは呼び出し側の処理が終わって次を要求した時点でキャッシュに保存し、
+    クエリ1回分ごとにカーソルを記録するため、途中で止まっても続きから再開できる。
+    """
+    cache = cache or NotionPageCache()
+
+    # 中断した同期があれば、同じ条件・カーソルで再開する
+    since = cache.get_state("cursor_since")
+    cursor = cache.get_state("cursor")
+    if cursor is None:
+        since = cache.get_state("watermark")
+    newest = cache.get_state("pending_watermark") or since
+
+    payload = {
+        "filter": POSITION_FILTER,
+        "sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}],
+    }
+    if since:
+        payload["filter"] = {"and": [
+            POSITION_FILTER,
+            {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since}},
+        ]}
+
+    def checkpoint(next_cursor):
+        cache.set_state(cursor=next_cursor, cursor_since=since if next_cursor else None,
+                        pending_watermark=newest if next_cursor else None)
+
+    changed = 0
+    try:
+        pages = iter_database_pages(payload, start_cursor=cursor, on_batch=checkpoint)
+        for page in pages:
+            edited = page.get("last_edited_time")
+            # 基準値と同じ時刻（分単位）に編集されたページは再取得されるため、変更がなければ飛ばす
+            if cache.last_edited_time(page["id"]) != edited:
+                changed += 1
+                yield page
+                cache.save(page)
+            newest = max(newest or "", edited or "")
+    except requests.HTTPError as e:
+        if cursor and e.response is not None and e.response.status_code == 400:
+            # 保存していたカーソルが無効になっている場合は、記録を消して次回は最初から取り直す
+            print(f"[Notion同期] 保存済みのカーソルが無効なため破棄します: {e}")
+            cache.set_state(cursor=None, cursor_since=None, pending_watermark=None)
+        raise
+
+    cache.set_state(watermark=newest, cursor=None, cursor_since=None, pending_watermark=None)
+    print(f"[Notion同期] 新規・更新 {changed} 件（基準日時: {newest}）")
+
+
+def _plain_text(prop):
+    items = (prop or {}).get("title") or (prop or {}).get("rich_text") or []
+    return "".join(item.get("plain_text") or item.get("text", {}).get("content", "") for item in items)
+
+
+def _names(prop):
+    return [item.get("name", "") for item in (prop or {}).get("multi_select") or []]
+
+
+# ヒアリングメモの見出しと context のキーの対応
+MEMO_LABELS = {
+    '現状': 'current_situation_value',
+    '問題': 'problem_value',
+    '最重要ニーズ': 'most_important_need_value',
+    '提案内容': 'proposal_content_value',
+    '検討理由': 'consideration_reason_value',
+}
+
+
+def page_to_lead(page):
+    """
+    Notion のページから、メール生成に使う (context, 送り先情報) を作る
+    """
+    props = page.get("properties", {})
+
+    context = {
+        'tantosha_value': "、".join(_names(props.get("担当"))),
+        'proposal_plan_value': "、".join(_names(props.get("製品"))),
+    }
+    # 「■現状\n内容」の形式でまとめられたヒアリングメモを項目ごとに戻す
+    memo = _plain_text(props.get("ヒアリングメモ"))
+    for label, body in re.findall(r"■(.+?)\n(.*?)(?=\n\n■|\Z)", memo, flags=re.DOTALL):
+        if label in MEMO_LABELS:
+            context[MEMO_LABELS[label]] = body.strip()
+
+    recipient_details = {
+        "page_id": page.get("id"),
+        "last_edited_time": page.get("last_edited_time"),
+        "会社名": _plain_text(props.get("会社名")),
+        "担当者氏名": _plain_text(props.get("担当者氏名")),
+        "部署": _plain_text(props.get("部署名")),
+        "役職": "、".join(_names(props.get("役職"))) or _plain_text(props.get("役職名")),
+        "Eメール": (props.get("メール") or {}).get("email") or "",
+        "電話番号": (props.get("電話番号") or {}).get("phone_number") or "",
+    }
+    return context, recipient_details
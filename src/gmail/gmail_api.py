@@ -5,37 +5,211 @@ from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import configparser
 import json
+import os
+import time
+import random
+import hashlib
+import threading
+from datetime import datetime
+
+# --- 設定 ---
+config = configparser.ConfigParser()
+config.read("config.ini", encoding="utf-8")
+
+SENDER = config["HOST"].get("SENDER", "")  # 差出人（省略時は Gmail アカウントの既定）
+GMAIL_BATCH_SIZE = min(100, int(config["HOST"].get("GMAIL_BATCH_SIZE", "20")))  # 1回のバッチで作成する下書き数
+GMAIL_MAX_RETRIES = int(config["HOST"].get("GMAIL_MAX_RETRIES", "3"))
+
+TOKEN_PATH = 'token.json'
+SCOPES = ['https://www.googleapis.com/auth/gmail.compose']
+
+# 作成した下書きの記録（page_id ごとの draft_id。再実行時に同じリードの下書きを重複して作らない）
+GMAIL_DRAFTS_PATH = os.path.join('cache', 'gmail_drafts.json')
+
+# 再試行の対象とするステータス（レート制限・サーバーエラー）
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """
+    Gmail API のサービスを一度だけ作成して使い回す。
+    ディスカバリー文書はライブラリ同梱のもの（static_discovery）を使い、毎回のダウンロードを避ける
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            # 認証情報の読み込み。必要なスコープは「gmail.compose」
+            creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+            _service = build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False)
+        return _service
+
+
+def create_message(sender, to, subject, message_text):
+    """
+    下書きに登録するメッセージ（base64url でエンコードした MIME）を作成する
+    """
+    message = MIMEText(message_text)
+    message['to'] = to
+    if sender:
+        message['from'] = sender
+    message['subject'] = subject
+    return {'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}
+
+
+def create_draft(service, user_id, message):
+    return service.users().drafts().create(userId=user_id, body={'message': message}).execute()
 
 
 def push_gmail(input_json, CONFIG):
     """
-    Gmail API を使用してメールの下書きを作成する関数
-    inout_json: {"sender1": "送信者", "recipient": "受信者", "title": "件名", "message_text": "本文"}
-    CONFIG: configparser.ConfigParser() のインスタンス
+    Gmail API を使用してメールの下書きを1件作成する関数
+    inout_json: {"メール": "受信者", "gmail": {"title": "件名", "message_text": "本文"}}
+    CONFIG: config.ini のセクション名
     """
-    
-    input_json["gmail"]["sender"] = config[CONFIG]["SENDER"] 
+    input_json["gmail"]["sender"] = config[CONFIG].get("SENDER", "")
     input_json["gmail"]["recipient"] = input_json["メール"]
-    
-    # Gmail API を使用してメールの下書きを作成するための関数を呼び出す
-    # input_json, token, flag = generate_gmail_content_for_GPT(input_json, CONFIG)
-    input_json, token = generate_gmail_content_for_gemini(input_json, CONFIG)
-    
-    if token == 0:
-        return input_json, 0
-    
-    # 認証情報の読み込み。必要なスコープは「gmail.compose」
-    creds = Credentials.from_authorized_user_file('token.json', ['https://www.googleapis.com/auth/gmail.compose'])
-    service = build('gmail', 'v1', credentials=creds)
 
     # メッセージ作成
     message = create_message(input_json["gmail"]["sender"],
                              input_json["gmail"]["recipient"],
                              input_json["gmail"]["title"],
                              input_json["gmail"]["message_text"])
-    
+
     # 下書きの作成（ユーザID は "me" で自分自身）
-    draft = create_draft(service, 'me', message)
+    draft = create_draft(get_service(), 'me', message)
     input_json["gmail"]["id"] = draft["id"]
-    
-    return input_json, token
\ No newline at end of file
+
+    return input_json, 0
+
+
+def email_hash(email: dict) -> str:
+    """
+    メールの件名と本文のハッシュ値（下書きの文面が変わったかの判定に使う）
+    """
+    h = hashlib.sha256()
+    h.update(email.get("タイトル", "").encode("utf-8"))
+    h.update(b"\0")
+    h.update(email.get("本文", "").encode("utf-8"))
+    return h.hexdigest()
+
+
+class DraftSink:
+    """
+    生成したメールを Gmail の下書きにまとめて登録する。
+    バッチリクエストで GMAIL_BATCH_SIZE 件ずつ送り、作成した draft_id を page_id ごとに記録する。
+    すでに下書きがあるリードは、生成した文面（件名・本文）が変わった場合だけ下書きを更新する
+    （Notion のステータス変更などでは Gmail 上で編集した下書きを上書きしない）。
+    送信・削除済みの下書きは作り直さない。
+    """
+    def __init__(self, batch_size=GMAIL_BATCH_SIZE, path=GMAIL_DRAFTS_PATH):
+        self.batch_size = max(1, batch_size)
+        self.path = path
+        self.drafts = self._load()
+
+    def push(self, records):
+        """
+        records: EmailBatch の記録（page_id, lead_key, recipient, email を持つ辞書）
+        (作成・更新した件数, 失敗した件数) を返す
+        """
+        pending = []
+        for record in records:
+            entry = self.drafts.get(record["page_id"])
+            if entry:
+                if entry.get("sent"):
+                    continue
+                if "email_hash" not in entry:
+                    # 以前の形式の記録は、今の文面で作成済みとみなす
+                    entry["email_hash"] = email_hash(record["email"])
+                if entry["email_hash"] == email_hash(record["email"]):
+                    continue
+            if not record["recipient"].get("Eメール"):
+                print(f"[Gmail] メールアドレスがないため下書きを作成しません: {record['recipient'].get('担当者氏名', '')}")
+                continue
+            pending.append(record)
+
+        succeeded, failed = 0, 0
+        for i in range(0, len(pending), self.batch_size):
+            done, errors = self._send_batch(pending[i:i + self.batch_size])
+            succeeded += done
+            failed += errors
+        self._save()
+        print(f"[Gmail] 下書き作成・更新 {succeeded} 件 / 失敗 {failed} 件")
+        return succeeded, failed
+
+    def _send_batch(self, records):
+        """
+        1回のバッチリクエストで下書きを作成（既存の下書きは更新）する。
+        レート制限・サーバーエラーになったものだけを、待機してから再送する
+        """
+        service = get_service()
+        remaining = {record["page_id"]: record for record in records}
+        succeeded, failed = 0, 0
+
+        for attempt in range(1, GMAIL_MAX_RETRIES + 1):
+            retry = {}
+
+            def callback(request_id, response, exception):
+                nonlocal succeeded, failed
+                record = remaining[request_id]
+                if exception is None:
+                    self._record(record, response["id"])
+                    succeeded += 1
+                elif (isinstance(exception, HttpError) and exception.resp.status == 404
+                      and request_id in self.drafts):
+                    # 更新しようとした下書きが見つからない場合は送信済み（または削除済み）とみなし、作り直さない
+                    self.drafts[request_id]["sent"] = True
+                    print(f"[Gmail] 下書きが送信・削除済みのため更新しません: {record['recipient'].get('Eメール')}")
+                elif (isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES
+                      and attempt < GMAIL_MAX_RETRIES):
+                    retry[request_id] = record
+                else:
+                    print(f"[Gmail] 下書きの作成に失敗しました ({record['recipient'].get('Eメール')}): {exception}")
+                    failed += 1
+
+            batch = service.new_batch_http_request(callback=callback)
+            for page_id, record in remaining.items():
+                message = create_message(SENDER, record["recipient"]["Eメール"],
+                                         record["email"]["タイトル"], record["email"]["本文"])
+                entry = self.drafts.get(page_id)
+                if entry:
+                    request = service.users().drafts().update(
+                        userId='me', id=entry["draft_id"], body={'id': entry["draft_id"], 'message': message}
+                    )
+                else:
+                    request = service.users().drafts().create(userId='me', body={'message': message})
+                batch.add(request, request_id=page_id)
+            batch.execute()
+            self._save()
+
+            if not retry:
+                break
+            remaining = retry
+            # 指数バックオフ（full jitter）
+            time.sleep(random.uniform(0, min(60.0, 2 ** attempt)))
+
+        return succeeded, failed
+
+    def _record(self, record, draft_id):
+        self.drafts[record["page_id"]] = {
+            "draft_id": draft_id,
+            "lead_key": record["lead_key"],
+            "email_hash": email_hash(record["email"]),
+            "recipient": record["recipient"].get("Eメール"),
+            "updated_at": datetime.now().isoformat(),
+        }
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.drafts, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
@@ -1,22 +1,36 @@
-from get_notion import query_database_all_position
+import argparse
+
+from get_notion import NotionPageCache, sync_database_incremental, page_to_lead
+from email_batch import EmailBatch
+from email_cache import email_cache
 import gmail_api
-import create_gmail 
 
-def main():
+def main(clear_email_cache=False):
     # notionデータベースからgmailの下書きを作成するスクリプト
-    
-    # notionデータベースの取得
-    database = query_database_all_position()
-    
-    # gamil文の作成
-    input_json = create_gmail.generate_email_with_gemini(database, exhibition_name="[展示会名]")
-    
-    # Gmail APIを使用してメールの下書きを作成
-    input_json, token = gmail_api.push_gmail(input_json, CONFIG)
-    
+
+    # プロンプトやテンプレートを変えた場合などは、生成済みメールのキャッシュを消して作り直す
+    if clear_email_cache:
+        email_cache.clear()
+
+    # notionデータベースの取得（前回以降に追加・編集されたリードだけをローカルキャッシュに反映する）
+    cache = NotionPageCache()
+    for _ in sync_database_incremental(cache):
+        pass
+
+    # gamil文の作成（キャッシュ内のリードを並列に生成し、生成済みのものは飛ばす）
+    leads = (page_to_lead(page) for page in cache.pages())
+    batch = EmailBatch(exhibition_name="[展示会名]")
+    batch.run(leads)
+
+    # Gmail APIを使用してメールの下書きを作成（まだ下書きがないリード・文面が変わったリードのみ）
+    gmail_api.DraftSink().push(batch.latest_records())
+
     return 0
 
 
 if __name__ == "__main__":
-    main()
-    
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Notionのリードからフォローアップメールの下書きを作成する")
+    parser.add_argument("--clear-email-cache", action="store_true", help="生成済みメールのキャッシュを削除してから実行する")
+    args = parser.parse_args()
+    main(clear_email_cache=args.clear_email_cache)
+
@@ -1,44 +1,410 @@
+import os
+import json
+import time
+import uuid
+import queue
 import threading
+import configparser
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:
+    # Windows ではプロセス間でジョブの処理権を取り合わない（1プロセスで動かす前提）
+    fcntl = None
+
 import main as process_cards_module
+from image_utils import image_normalizer
+
+config = configparser.ConfigParser()
+# 現在のスクリプトの場所を基準に設定ファイルのパスを決定
+config_path = os.path.join(os.path.dirname(__file__), "..", "..", "config.ini")
+config.read(config_path, encoding="utf-8")
+
+# 同時に処理するジョブ数（SSH接続・OCR・Notion書き込みの同時実行数の上限）
+WORKER_COUNT = int(config["HOST"].get("WORKER_COUNT", "2"))
+
+# ジョブの永続化先（1ジョブ = 1 JSONファイル）
+STATUS_DIR = 'status'
+
+# 完了・失敗したジョブを保持する時間（0 以下なら削除しない）と、掃除の間隔（秒）
+JOB_RETENTION_HOURS = float(config["HOST"].get("JOB_RETENTION_HOURS", "24"))
+JOB_SWEEP_INTERVAL = float(config["HOST"].get("JOB_SWEEP_INTERVAL", "3600"))
+
+# 再起動時に再開の対象とするステータス
+RESUMABLE_STATUSES = ("queued", "processing")
+
+# 処理が終わり、保持期間を過ぎたら削除してよいステータス
+FINISHED_STATUSES = ("completed", "failed")
+
+# 処理段階（main.main から通知される順）と表示名
+STAGES = (
+    ("upload", "画像アップロード"),
+    ("ocr", "OCR解析"),
+    ("notion_create", "Notionページ作成"),
+    ("image_blocks", "画像ブロック追加"),
+    ("cleanup", "後片付け"),
+)
+STAGE_LABELS = dict(STAGES)
+STAGE_STATE_LABELS = {"running": "実行中", "done": "完了", "skipped": "スキップ", "failed": "失敗"}
+
+# API 応答に含めないフィールド（入力データには個人情報が含まれるため）
+PRIVATE_FIELDS = ("payload",)
+
 
 class BackgroundProcessor:
-    def __init__(self):
-        pass
-    
-    def start_background_process(self, business_card_path: str, hearing_seed_paths: list, lead_date: str, context: dict):
-        """
-        バックグラウンドで処理を開始（ジョブIDなどは不要）
-        """
-        # バックグラウンドで処理を開始
-        thread = threading.Thread(
-            target=self._process_in_background,
-            args=(business_card_path, hearing_seed_paths, lead_date, context)
-        )
-        thread.daemon = True
-        thread.start()
-    
-    
-    def _process_in_background(self, business_card_path: str, hearing_seed_paths: list, lead_date: str, context: dict):
+    def __init__(self, worker_count: int = WORKER_COUNT, status_dir: str = STATUS_DIR):
+        self.worker_count = max(1, worker_count)
+        self.status_dir = status_dir
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._sweeper = None
+        self._started = False
+        # ジョブ状態のメモリ上のキャッシュ（API はディスクを読まずにここを参照する）
+        self._jobs = {}
+        self._jobs_changed = threading.Condition()
+        # このプロセスが処理権を持っているジョブのロックファイル
+        self._claims = {}
+        self._claims_lock = threading.Lock()
+        if not os.path.exists(self.status_dir): os.makedirs(self.status_dir)
+
+    def start(self):
+        """
+        ワーカースレッドを起動し、前回終了時に残っていたジョブを再投入する（複数回呼んでも一度だけ実行）
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+            self._load_jobs()
+            self._resume_pending_jobs()
+
+            for i in range(self.worker_count):
+                worker = threading.Thread(target=self._worker_loop, name=f"card-worker-{i + 1}")
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+            # 終わったジョブがメモリと status ディレクトリに溜まり続けないよう、定期的に削除する
+            self._sweeper = threading.Thread(target=self._sweep_loop, args=(JOB_SWEEP_INTERVAL,), name="job-sweeper")
+            self._sweeper.daemon = True
+            self._sweeper.start()
+
+        print(f"[バックグラウンド] ワーカーを {self.worker_count} 件起動しました")
+
+    def start_background_process(self, business_card_path: str, hearing_seed_paths: list, lead_date: str, context: dict) -> str:
+        """
+        ジョブをディスクに保存してキューに投入し、ジョブIDを返す
+        """
+        self.start()
+
+        job_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "created_at": now,
+            "updated_at": now,
+            "progress": 0,
+            "message": "処理待ち",
+            "result": None,
+            "error": None,
+            "stage": None,
+            "stages": {stage: "pending" for stage, _ in STAGES},
+            # 再起動後に処理を再開するための入力
+            "payload": {
+                "business_card_path": business_card_path,
+                "hearing_seed_paths": hearing_seed_paths,
+                "lead_date": lead_date,
+                "context": context,
+            },
+        }
+        self._claim(job_id)
+        with self._jobs_changed:
+            self._jobs[job_id] = job
+        self._write_job(job)
+        self._queue.put(job_id)
+        print(f"[バックグラウンド] ジョブを登録しました: {job_id} (待機数: {self._queue.qsize()})")
+        return job_id
+
+    def get_job(self, job_id: str):
+        """
+        ジョブの状態を返す（存在しない場合は None）
+        """
+        with self._jobs_changed:
+            job = self._jobs.get(job_id)
+            return self._public_view(job) if job else None
+
+    def list_jobs(self, status: str = None, limit: int = 50) -> list:
+        """
+        ジョブの一覧を新しい順に返す
+        """
+        with self._jobs_changed:
+            jobs = [job for job in self._jobs.values() if not status or job.get("status") == status]
+            jobs.sort(key=lambda j: j.get("created_at", ""), reverse=True)
+            return [self._public_view(job) for job in jobs[:limit]]
+
+    def wait_for_job(self, job_id: str, since: str = None, timeout: float = 25.0):
+        """
+        ロングポーリング用：ジョブの updated_at が since から変わるか、完了するまで最大 timeout 秒待つ
+        """
+        def changed():
+            job = self._jobs.get(job_id)
+            return job is None or job.get("updated_at") != since or job.get("status") in ("completed", "failed")
+
+        with self._jobs_changed:
+            if since:
+                self._jobs_changed.wait_for(changed, timeout=timeout)
+            job = self._jobs.get(job_id)
+            return self._public_view(job) if job else None
+
+    def sweep(self, retention_hours: float = JOB_RETENTION_HOURS) -> int:
+        """
+        保持期間を過ぎた完了・失敗ジョブをメモリ上のキャッシュとディスクから削除する。削除した件数を返す
+        """
+        if retention_hours <= 0:
+            return 0
+        cutoff = (datetime.now() - timedelta(hours=retention_hours)).isoformat()
+        with self._jobs_changed:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.get("status") in FINISHED_STATUSES and job.get("updated_at", "") < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+        for job_id in expired:
+            try:
+                os.remove(self._job_path(job_id))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[バックグラウンド] ジョブファイルの削除に失敗しました ({job_id}): {e}")
+        if expired:
+            print(f"[バックグラウンド] 保持期間を過ぎたジョブを {len(expired)} 件削除しました")
+        return len(expired)
+
+    def _sweep_loop(self, interval: float):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[バックグラウンド] 終了したジョブの掃除中にエラーが発生しました: {e}")
+            time.sleep(interval)
+
+    def _worker_loop(self):
+        """
+        キューからジョブIDを取り出して順に処理する
+        """
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run_job(job_id)
+            except Exception as e:
+                print(f"[バックグラウンド] ジョブ {job_id} の管理処理でエラーが発生しました: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _run_job(self, job_id: str):
         """
         バックグラウンドで実際の処理を実行
         """
+        with self._jobs_changed:
+            job = self._jobs.get(job_id)
+        if job is None:
+            job = self._read_job(job_id)
+        if job is None:
+            print(f"[バックグラウンド] ジョブファイルが見つかりません: {job_id}")
+            self._release(job_id)
+            return
         try:
-            print("[バックグラウンド] 処理を開始しています...")
-            
+            self._process_job(job)
+        finally:
+            self._release(job_id)
+
+    def _process_job(self, job: dict):
+        job_id = job["job_id"]
+
+        payload = job.get("payload") or {}
+        job.setdefault("stages", {stage: "pending" for stage, _ in STAGES})
+        self._update_job(job, status="processing", progress=0, message="処理中")
+
+        def on_progress(stage: str, state: str = "running"):
+            self._record_stage(job, stage, state)
+
+        def on_checkpoint(**fields):
+            # 作成したページなどを記録し、中断しても再開時にページを作成し直さないようにする
+            self._update_job(job, **fields)
+
+        try:
+            print(f"[バックグラウンド] 処理を開始しています... ({job_id})")
+
+            # 受付時に投入した画像の変換（JPEG への正規化）が終わるのを待つ
+            business_card_path = payload.get("business_card_path")
+            if business_card_path and not image_normalizer.wait(business_card_path):
+                raise ValueError("名刺画像の変換に失敗しました")
+            hearing_seed_paths = [p for p in payload.get("hearing_seed_paths") or [] if image_normalizer.wait(p)]
+
             # 実際の処理を実行
             result_code = process_cards_module.main(
-                business_card_path, hearing_seed_paths, lead_date, context
+                business_card_path,
+                hearing_seed_paths,
+                payload.get("lead_date"),
+                payload.get("context") or {},
+                on_progress=on_progress,
+                resume={"page_id": job.get("page_id"), "images_attached": job.get("images_attached", False)},
+                on_checkpoint=on_checkpoint,
             )
-            
+
             # 結果をログ出力
             if result_code == 0:
-                print("[バックグラウンド] 処理が正常に完了しました")
+                print(f"[バックグラウンド] 処理が正常に完了しました ({job_id})")
+                self._update_job(job, status="completed", progress=100, message="処理完了", result=result_code)
             else:
-                print(f"[バックグラウンド] 処理でエラーが発生しました (code: {result_code})")
-                
+                print(f"[バックグラウンド] 処理でエラーが発生しました (code: {result_code}, job: {job_id})")
+                self._update_job(job, status="failed", message="処理でエラーが発生しました", result=result_code,
+                                 error=f"result code {result_code}", stages=self._failed_stages(job))
+
         except Exception as e:
             print(f"[バックグラウンド] 処理中にエラーが発生しました: {e}")
-    
+            self._update_job(job, status="failed", message="処理中にエラーが発生しました", error=str(e),
+                             stages=self._failed_stages(job))
+
+    def _record_stage(self, job: dict, stage: str, state: str):
+        """
+        main.main から通知された段階の状態を記録し、進捗率を更新する
+        """
+        stages = dict(job.get("stages") or {})
+        stages[stage] = state
+        finished = sum(1 for s in stages.values() if s in ("done", "skipped"))
+        progress = int(finished * 100 / len(STAGES))
+        message = f"{STAGE_LABELS.get(stage, stage)}: {STAGE_STATE_LABELS.get(state, state)}"
+        self._update_job(job, stage=stage, stages=stages, progress=progress, message=message)
+
+    @staticmethod
+    def _failed_stages(job: dict) -> dict:
+        """
+        実行中だった段階を失敗として記録した stages を返す
+        """
+        stages = dict(job.get("stages") or {})
+        stage = job.get("stage")
+        if stage and stages.get(stage) == "running":
+            stages[stage] = "failed"
+        return stages
+
+    def _load_jobs(self):
+        """
+        起動時に status ディレクトリのジョブを一度だけ読み込み、メモリ上のキャッシュを作る
+        """
+        for filename in os.listdir(self.status_dir):
+            if not filename.endswith(".json"):
+                continue
+            job = self._read_job(filename[:-5])
+            if job is None or not job.get("job_id"):
+                continue
+            with self._jobs_changed:
+                self._jobs[job["job_id"]] = job
+
+    def _resume_pending_jobs(self):
+        """
+        未完了のジョブを作成順にキューへ戻す。
+        他のサーバープロセスが処理中・処理待ちのジョブ（処理権を取得できないもの）は再開しない
+        """
+        pending = []
+        with self._jobs_changed:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job_id = job["job_id"]
+            if job.get("status") not in RESUMABLE_STATUSES:
+                continue
+            if not self._claim(job_id):
+                continue
+            # 処理権を取得する前に他のプロセスが完了させている場合があるため、ファイルを読み直す
+            job = self._read_job(job_id)
+            if job is None or job.get("status") not in RESUMABLE_STATUSES:
+                if job is not None:
+                    with self._jobs_changed:
+                        self._jobs[job_id] = job
+                self._release(job_id)
+                continue
+            if not job.get("payload"):
+                print(f"[バックグラウンド] 再開に必要な入力がないためスキップします: {job_id}")
+                self._release(job_id)
+                continue
+            pending.append(job)
+
+        pending.sort(key=lambda j: j.get("created_at", ""))
+        for job in pending:
+            self._update_job(job, status="queued", progress=0, message="再起動後の処理待ち", stage=None,
+                             stages={stage: "pending" for stage, _ in STAGES})
+            self._queue.put(job["job_id"])
+
+        if pending:
+            print(f"[バックグラウンド] 未完了のジョブを {len(pending)} 件再開します")
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self.status_dir, f"{job_id}.json")
+
+    def _claim(self, job_id: str) -> bool:
+        """
+        ジョブの処理権を取得する。ロックファイルを処理が終わるまで保持し、
+        同じ status ディレクトリを使う他のサーバープロセスが同じジョブを再開しないようにする
+        （プロセスが落ちるとロックは自動的に解放される）
+        """
+        if fcntl is None:
+            return True
+        lock_file = open(self._job_path(job_id) + ".lock", 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        with self._claims_lock:
+            self._claims[job_id] = lock_file
+        return True
+
+    def _release(self, job_id: str):
+        with self._claims_lock:
+            lock_file = self._claims.pop(job_id, None)
+        if lock_file is None:
+            return
+        try:
+            os.remove(lock_file.name)
+        except OSError:
+            pass
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def _read_job(self, job_id: str):
+        try:
+            with open(self._job_path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"[バックグラウンド] ジョブファイルの読み込みに失敗しました ({job_id}): {e}")
+            return None
+
+    def _write_job(self, job: dict):
+        """
+        一時ファイルに書き出してから置き換え、途中で落ちても壊れたJSONが残らないようにする
+        """
+        path = self._job_path(job["job_id"])
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+    def _update_job(self, job: dict, **fields):
+        with self._jobs_changed:
+            job.update(fields)
+            job["updated_at"] = datetime.now().isoformat()
+            self._jobs[job["job_id"]] = job
+            snapshot = dict(job)
+            self._jobs_changed.notify_all()
+        self._write_job(snapshot)
+
+    @staticmethod
+    def _public_view(job: dict) -> dict:
+        return {k: v for k, v in job.items() if k not in PRIVATE_FIELDS}
+
 
 # グローバルインスタンス
-background_processor = BackgroundProcessor()
\ No newline at end of file
+background_processor = BackgroundProcessor()
@@ -0,0 +1,345 @@
+import io
+import os
+import json
+import uuid
+import zipfile
+import argparse
+import threading
+import configparser
+from datetime import datetime
+
+from werkzeug.utils import secure_filename
+
+import ocr
+import pub_internet
+import creteNotionPerties as cnp
+from notion_writer import notion_writer
+from notion_api import NotionAPIError
+from lead_index import lead_index, DUPLICATE_LEAD_MODE
+from image_utils import convert_to_jpeg
+
+config = configparser.ConfigParser()
+# 現在のスクリプトの場所を基準に設定ファイルのパスを決定
+config_path = os.path.join(os.path.dirname(__file__), "..", "..", "config.ini")
+config.read(config_path, encoding="utf-8")
+
+# 一括取り込みで同時に OCR する件数
+BATCH_OCR_CONCURRENCY = int(config["HOST"].get("BATCH_OCR_CONCURRENCY", "4"))
+
+# Web（POST /api/batch）からフォルダを指定して取り込めるのは、このフォルダ配下のみ（空ならWebからのフォルダ指定は不可）
+BATCH_IMPORT_ROOT = config["HOST"].get("BATCH_IMPORT_ROOT", "").strip()
+
+# 一括取り込みの作業フォルダ（batches/<batch_id>/ に画像とチェックポイントを置く）
+BATCH_DIR = 'batches'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+
+
+class BatchImport:
+    """
+    フォルダまたはzipの名刺画像をまとめて OCR し、Notion にページを作成する一括取り込み。
+    結果は batches/<batch_id>/checkpoint.jsonl に1件ずつ追記するため、中断しても続きから再開できる。
+    """
+    def __init__(self, batch_id: str = None, context: dict = None, lead_date: str = None):
+        self.batch_id = batch_id or str(uuid.uuid4())
+        self.dir = os.path.join(BATCH_DIR, self.batch_id)
+        self.images_dir = os.path.join(self.dir, 'images')
+        self.checkpoint_path = os.path.join(self.dir, 'checkpoint.jsonl')
+        self.meta_path = os.path.join(self.dir, 'batch.json')
+        os.makedirs(self.images_dir, exist_ok=True)
+
+        meta = self._load_meta()
+        self.context = context if context is not None else meta.get('context', {})
+        today = datetime.now()
+        self.lead_date = lead_date or meta.get('lead_date') or f"{today.year}/{today.month}/{today.day}"
+        self._save_meta()
+
+        self._checkpoint_lock = threading.Lock()
+        self._changed = threading.Condition()
+        self.status = {
+            'batch_id': self.batch_id,
+            'state': 'preparing',
+            'total': 0,
+            'ocr_done': 0,
+            'pages_created': 0,
+            'duplicates': 0,
+            'failed': 0,
+            'message': '準備中',
+            'updated_at': datetime.now().isoformat(),
+        }
+
+    # --- 入力画像の準備 ---
+    def add_source(self, source: str):
+        """
+        フォルダまたはzipファイル内の画像を正規化（JPEG・リサイズ）して作業フォルダに取り込む
+        """
+        if zipfile.is_zipfile(source):
+            with zipfile.ZipFile(source) as zf:
+                members = sorted(m for m in zf.namelist() if m.lower().endswith(IMAGE_EXTENSIONS))
+                for i, member in enumerate(members):
+                    self._import_image(i, member, lambda m=member: io.BytesIO(zf.read(m)))
+        elif os.path.isdir(source):
+            names = sorted(n for n in os.listdir(source) if n.lower().endswith(IMAGE_EXTENSIONS))
+            for i, name in enumerate(names):
+                self._import_image(i, name, lambda n=name: os.path.join(source, n))
+        else:
+            raise ValueError(f"フォルダまたはzipファイルを指定してください: {source}")
+
+    def _import_image(self, index: int, name: str, open_source):
+        stem = secure_filename(os.path.splitext(os.path.basename(name))[0]) or "card"
+        dest_path = os.path.join(self.images_dir, f"{index:04d}_{stem}.jpeg")
+        if os.path.exists(dest_path):
+            return
+        try:
+            convert_to_jpeg(open_source(), dest_path)
+        except Exception as e:
+            print(f"[一括取り込み] 画像 '{name}' の変換に失敗したためスキップします: {e}")
+
+    # --- 実行 ---
+    def run(self, source: str = None) -> dict:
+        """
+        取り込み → OCR → Notion ページ作成 を行い、最終的な状態を返す。
+        チェックポイントに記録済みの OCR 結果・作成済みページはやり直さない。
+        """
+        try:
+            if source:
+                self.add_source(source)
+
+            images = sorted(n for n in os.listdir(self.images_dir) if n.endswith('.jpeg'))
+            records = self._read_checkpoint()
+            self._update(state='ocr', total=len(images),
+                         ocr_done=sum(1 for n in images if records.get(n, {}).get('ocr')),
+                         pages_created=sum(1 for n in images if records.get(n, {}).get('page_id')),
+                         message='OCR処理中')
+
+            # 1) OCR（同時実行数を制限し、1件終わるごとにチェックポイントへ追記）
+            pending = [n for n in images if not records.get(n, {}).get('ocr')]
+            if pending:
+                image_urls = [ocr.image_to_data_url(os.path.join(self.images_dir, n)) for n in pending]
+
+                progress_lock = threading.Lock()
+
+                def on_result(index, result):
+                    # OCR のイベントループではなくスレッドプールから呼ばれる（fsync で他の OCR を止めない）
+                    name = pending[index]
+                    with progress_lock:
+                        records.setdefault(name, {})['ocr'] = result
+                        self._append_checkpoint({'file': name, 'ocr': result})
+                        if result:
+                            self._update(ocr_done=self.status['ocr_done'] + 1)
+                        print(f"[一括取り込み] OCR {self.status['ocr_done']}/{self.status['total']}: {name}")
+
+                ocr.ocr_service.run(
+                    lambda client: ocr.ocr_multiple_images_async(
+                        image_urls, concurrency=BATCH_OCR_CONCURRENCY, client=client, on_result=on_result
+                    )
+                ).result()
+
+            # 2) Notion ページ作成（書き込みサービスにまとめて投入し、受け付け順に結果を記録）
+            self._update(state='notion', message='Notionページ作成中')
+            failed = 0
+            submitted = []
+            for name in images:
+                record = records.get(name, {})
+                if record.get('page_id'):
+                    continue
+                if record.get('ambiguous'):
+                    # 前回の作成が Notion 側で処理されたか分からないため、二重作成しないよう再送しない
+                    print(f"[一括取り込み] ページ作成済みか不明なため再送しません（データベースを確認してください）: {name}")
+                    failed += 1
+                    continue
+                if not record.get('ocr'):
+                    failed += 1
+                    continue
+                duplicate_id = lead_index.find_duplicate(record['ocr']) if DUPLICATE_LEAD_MODE != "create" else None
+                if duplicate_id:
+                    if self._merge_duplicate(name, duplicate_id) != 0:
+                        failed += 1
+                        continue
+                    record['page_id'] = duplicate_id
+                    self._append_checkpoint({'file': name, 'page_id': duplicate_id, 'duplicate': True})
+                    self._update(duplicates=self.status['duplicates'] + 1)
+                    continue
+                try:
+                    submitted.append((name, self._submit_page(name, record['ocr'])))
+                except Exception as e:
+                    print(f"[一括取り込み] 名刺画像のアップロードエラー ({name}): {e}")
+                    failed += 1
+
+            for name, future in submitted:
+                record = records[name]
+                try:
+                    page_id = future.result()
+                except NotionAPIError:
+                    record['ambiguous'] = True
+                    self._append_checkpoint({'file': name, 'ambiguous': True})
+                    failed += 1
+                    continue
+                if page_id:
+                    record['page_id'] = page_id
+                    lead_index.record(page_id, record['ocr'])
+                    self._append_checkpoint({'file': name, 'page_id': page_id})
+                    self._update(pages_created=self.status['pages_created'] + 1)
+                    print(f"[一括取り込み] ページ作成 {self.status['pages_created']}/{self.status['total']}: {name}")
+                else:
+                    failed += 1
+
+            self._update(state='completed', failed=failed,
+                         message=f"完了（作成 {self.status['pages_created']} 件 / 重複 {self.status['duplicates']} 件 / 失敗 {failed} 件）")
+
+        except Exception as e:
+            print(f"[一括取り込み] 処理中にエラーが発生しました: {e}")
+            self._update(state='failed', message=f"処理中にエラーが発生しました: {e}")
+
+        return self.get_status()
+
+    def _submit_page(self, name: str, analysis_result: dict):
+        """
+        名刺画像をアップロードし、ページ作成を書き込みサービスに投入して Future を返す
+        """
+        card_path = os.path.join(self.images_dir, name)
+        unique_id = pub_internet.new_upload_id()
+        pub_internet.upload_card(unique_id, card_path)
+
+        properties = cnp.build_notion_properties(analysis_result, self.lead_date, self.context)
+        return notion_writer.submit(properties, cnp.build_image_blocks(unique_id, card_path, []))
+
+    def _merge_duplicate(self, name: str, page_id: str) -> int:
+        """
+        既存リードと重複した名刺を扱う。merge なら既存ページに名刺画像を追記し、skip なら何もしない。
+        成功時は 0、失敗時は 1 を返す
+        """
+        if DUPLICATE_LEAD_MODE == "skip":
+            print(f"[一括取り込み] 既存ページ {page_id} と重複するためスキップします: {name}")
+            return 0
+        print(f"[一括取り込み] 既存ページ {page_id} に統合します: {name}")
+        try:
+            card_path = os.path.join(self.images_dir, name)
+            unique_id = pub_internet.new_upload_id()
+            pub_internet.upload_card(unique_id, card_path)
+        except Exception as e:
+            print(f"[一括取り込み] 名刺画像のアップロードエラー ({name}): {e}")
+            return 1
+        children = cnp.build_merge_blocks(self.context, self.lead_date) + cnp.build_image_blocks(unique_id, card_path, [])
+        return cnp.append_blocks(page_id, children, "追加ヒアリング")
+
+    # --- 進捗 ---
+    def get_status(self) -> dict:
+        with self._changed:
+            return dict(self.status)
+
+    def wait_for_update(self, since: str = None, timeout: float = 25.0) -> dict:
+        """
+        ロングポーリング用：updated_at が since から変わるか、終了するまで最大 timeout 秒待つ
+        """
+        def changed():
+            return self.status['updated_at'] != since or self.status['state'] in ('completed', 'failed')
+
+        with self._changed:
+            if since:
+                self._changed.wait_for(changed, timeout=timeout)
+            return dict(self.status)
+
+    def _update(self, **fields):
+        with self._changed:
+            self.status.update(fields)
+            self.status['updated_at'] = datetime.now().isoformat()
+            self._changed.notify_all()
+
+    # --- チェックポイント ---
+    def _read_checkpoint(self) -> dict:
+        records = {}
+        if not os.path.exists(self.checkpoint_path):
+            return records
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で落ちた最終行は無視する
+                    continue
+                records.setdefault(entry.pop('file'), {}).update(entry)
+        return records
+
+    def _append_checkpoint(self, entry: dict):
+        with self._checkpoint_lock:
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _load_meta(self) -> dict:
+        if not os.path.exists(self.meta_path):
+            return {}
+        with open(self.meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_meta(self):
+        with open(self.meta_path, 'w', encoding='utf-8') as f:
+            json.dump({'context': self.context, 'lead_date': self.lead_date}, f, ensure_ascii=False, indent=2)
+
+
+# --- Web API から使うためのバッチ管理 ---
+_batches = {}
+_batches_lock = threading.Lock()
+
+
+def start_batch(source: str, context: dict, lead_date: str) -> str:
+    """
+    一括取り込みをバックグラウンドで開始し、バッチIDを返す
+    """
+    batch = BatchImport(context=context, lead_date=lead_date)
+    with _batches_lock:
+        _batches[batch.batch_id] = batch
+    thread = threading.Thread(target=batch.run, args=(source,), name=f"batch-{batch.batch_id[:8]}")
+    thread.daemon = True
+    thread.start()
+    return batch.batch_id
+
+
+def get_batch(batch_id: str):
+    with _batches_lock:
+        return _batches.get(batch_id)
+
+
+def resolve_import_folder(folder: str):
+    """
+    Web から指定されたフォルダを BATCH_IMPORT_ROOT 配下に限定して解決する。
+    BATCH_IMPORT_ROOT 未設定・配下の外・存在しないフォルダの場合は None を返す
+    """
+    if not BATCH_IMPORT_ROOT or not folder:
+        return None
+    root = os.path.realpath(BATCH_IMPORT_ROOT)
+    path = os.path.realpath(os.path.join(root, folder))
+    if os.path.commonpath([root, path]) != root or not os.path.isdir(path):
+        return None
+    return path
+
+
+def build_batch_context(tantosha: str, proposal_plan: str = '') -> dict:
+    """
+    一括取り込みで作成するページ共通の担当者・提案プラン（フォームの context と同じキー）
+    """
+    return {
+        'tantosha_value': tantosha,
+        'proposal_plan_value': proposal_plan,
+        'source_tantosha': '',
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="名刺画像の一括取り込み（フォルダまたはzip）")
+    parser.add_argument("source", nargs="?", help="名刺画像のフォルダまたはzipファイル")
+    parser.add_argument("--tantosha", help="担当者名")
+    parser.add_argument("--lead-date", help="リード獲得日 (例: 2025/3/12)")
+    parser.add_argument("--plan", default="", help="提案プラン")
+    parser.add_argument("--resume", metavar="BATCH_ID", help="中断したバッチを再開する")
+    args = parser.parse_args()
+
+    if not args.resume and not (args.source and args.tantosha):
+        parser.error("source と --tantosha を指定するか、--resume でバッチIDを指定してください")
+
+    context = build_batch_context(args.tantosha, args.plan) if args.tantosha else None
+    batch = BatchImport(batch_id=args.resume, context=context, lead_date=args.lead_date)
+    print(f"[一括取り込み] バッチID: {batch.batch_id}")
+    result = batch.run(args.source)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
@@ -1,8 +1,9 @@
 import datetime
-import requests
 import configparser
 import os
 
+from notion_api import notion_client, dead_letters, NotionAPIError
+
 
 config = configparser.ConfigParser()
 # 現在のスクリプトの場所を基準に設定ファイルのパスを決定
@@ -20,6 +21,9 @@ DEFAULT_TAG = config["HOST"]["DEFAULT_TAG"].replace('"', '')
 # public file sever
 UPLOAD_URL = config["HOST"]["UPLOAD_URL"]
 
+# Notion API で1リクエストに含められるブロック数の上限
+MAX_BLOCKS_PER_REQUEST = 100
+
 def get_perusona(context):
     """
     ペルソナを決定する関数。
@@ -49,6 +53,29 @@ def get_perusona(context):
     return persona_map.get(index, "D")
     
     
+def build_hearing_memo(context):
+    """
+    ヒアリング項目を「■項目名\n内容」の形式で1つのテキストにまとめる
+    """
+    memo_items = {
+        'current_situation_value': '現状',
+        'problem_value': '問題',
+        'most_important_need_value': '最重要ニーズ',
+        'proposal_content_value': '提案内容',
+        'consideration_reason_value': '検討理由'
+    }
+    
+    # メモの内容を生成
+    memo_content_lines = []
+    for key, label in memo_items.items():
+        value = context.get(key, "").strip()
+        if value:
+            memo_content_lines.append(f"■{label}\n{value}")
+    
+    # 全ての行を結合（各項目の後に空行を入れる）
+    return "\n\n".join(memo_content_lines)
+
+
 # notion データベースプロパティの組み立て
 def build_notion_properties(business_card_data, lead_date_str, context):
     # OCR結果がNoneまたは空の場合の処理
@@ -167,23 +194,7 @@ def build_notion_properties(business_card_data, lead_date_str, context):
         properties["担当"] = {"multi_select": [{"name": "担当者不明"}]}
     
     # ▼ ヒアリングメモ: rich_text 型（統合されたヒアリング情報）
-    memo_items = {
-        'current_situation_value': '現状',
-        'problem_value': '問題',
-        'most_important_need_value': '最重要ニーズ',
-        'proposal_content_value': '提案内容',
-        'consideration_reason_value': '検討理由'
-    }
-    
-    # メモの内容を生成
-    memo_content_lines = []
-    for key, label in memo_items.items():
-        value = context.get(key, "").strip()
-        if value:
-            memo_content_lines.append(f"■{label}\n{value}")
-    
-    # 全ての行を結合（各項目の後に空行を入れる）
-    memo_full_content = "\n\n".join(memo_content_lines)
+    memo_full_content = build_hearing_memo(context)
     
     if memo_full_content:
         properties["ヒアリングメモ"] = {
@@ -283,110 +294,172 @@ def build_notion_properties(business_card_data, lead_date_str, context):
     return properties
 
 
-def create_notion_page(properties):
+def create_notion_page(properties, children=None):
     """
     Notion API を呼び出してページを作成する関数。
+    children（画像ブロックなど）を渡すと、ページ作成と同じリクエストで本文も登録する。
+    1リクエストの上限（100ブロック）を超えた分は作成後に追加する。
+    失敗した場合（再試行後も）は None を返す。
+    ただし Notion 側で作成されたか分からない失敗（ambiguous）は、二重作成を防ぐため NotionAPIError を送出する。
     """
-    url = "https://api.notion.com/v1/pages"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": NOTION_VERSION,
-    }
+    children = children or []
     payload = {
         "parent": {"database_id": DATABASE_ID},
         "properties": properties,
     }
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code == 200:
-        print("[*]Notionページの作成に成功しました。")
-        page = response.json()
-        return page.get("id")
-    else:
-        print(f"Notionページ作成エラー: {response.text}")
+    if children:
+        payload["children"] = children[:MAX_BLOCKS_PER_REQUEST]
+    try:
+        page = notion_client.create_page(payload)
+    except NotionAPIError as e:
+        print(f"Notionページ作成エラー: {e}")
+        if e.ambiguous:
+            print("[警告] Notion側でページが作成されている可能性があります。再送前にデータベースを確認してください。")
+            raise
+        return None
+    print("[*]Notionページの作成に成功しました。")
+    page_id = page.get("id")
+
+    remaining = children[MAX_BLOCKS_PER_REQUEST:]
+    if remaining and append_blocks(page_id, remaining) != 0:
+        save_failed_lead(properties, remaining, page_id=page_id, error="画像ブロックの追加に失敗しました")
+    return page_id
 
 
-def append_image_blocks(page_id, unique_id, card_image, hearing_images):
+def image_block(url):
     """
-    作成済みのページ（page_id）の本文に、外部画像URLを用いた画像ブロックを追加する関数です。
-    image_urls は追加する画像のURLのリスト。
+    外部画像URLを表示する画像ブロック
     """
-    url = f"https://api.notion.com/v1/blocks/{page_id}/children"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": NOTION_VERSION,
-    }
-    children = []
-    
-    # 名刺画像の追加
-    card_url = UPLOAD_URL + unique_id + "/card/" + os.path.basename(card_image)
-    children.append({
+    return {
         "object": "block",
         "type": "image",
         "image": {
             "type": "external",
-            "external": {"url": card_url}
+            "external": {"url": url}
         }
-    })
-    
-    # ヒアリングシート画像の追加
-    for img_name in hearing_images:
-
-        img_url = UPLOAD_URL + unique_id + "/hearing/" + os.path.basename(img_name)
-        children.append({
-            "object": "block",
-            "type": "image",
-            "image": {
-                "type": "external",
-                "external": {"url": img_url}
-            }
-        })
-
-    data = {"children": children}
-    response = requests.patch(url, headers=headers, json=data)
-    if response.status_code == 200:
-        print("[*]画像ブロックの追加に成功しました。")
-        return 0
-    else:
-        print(f"画像ブロック追加エラー: {response.text}")
-        return 1
+    }
 
 
-def append_hearing_images_only(page_id, unique_id, hearing_images):
+def paragraph_block(text):
     """
-    ヒアリングシート画像のみをページに追加する関数（手入力モード用）
+    テキストの段落ブロック
     """
-    url = f"https://api.notion.com/v1/blocks/{page_id}/children"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": NOTION_VERSION,
+    return {
+        "object": "block",
+        "type": "paragraph",
+        "paragraph": {
+            "rich_text": [{"type": "text", "text": {"content": text}}]
+        }
     }
+
+
+def build_merge_blocks(context, lead_date_str):
+    """
+    既存ページに統合するときに追記する、追加ヒアリングの見出しとメモのブロック
+    """
+    tantosha = context.get("tantosha_value", "").strip() or "担当者不明"
+    blocks = [paragraph_block(f"■追加ヒアリング（{lead_date_str or '日付不明'} / 担当: {tantosha}）")]
+    memo = build_hearing_memo(context)
+    if memo:
+        blocks.append(paragraph_block(memo))
+    return blocks
+
+
+def build_image_blocks(unique_id, card_image, hearing_images, card_url=None):
+    """
+    名刺画像（card_image が None の場合は省略）とヒアリングシート画像の画像ブロックを組み立てる
+    """
     children = []
-    
+
+    # 名刺画像の追加
+    if card_image or card_url:
+        if not card_url:
+            card_url = UPLOAD_URL + unique_id + "/card/" + os.path.basename(card_image)
+        children.append(image_block(card_url))
+
     # ヒアリングシート画像の追加
     for img_name in hearing_images:
         img_url = UPLOAD_URL + unique_id + "/hearing/" + os.path.basename(img_name)
-        children.append({
-            "object": "block",
-            "type": "image",
-            "image": {
-                "type": "external",
-                "external": {"url": img_url}
-            }
-        })
+        children.append(image_block(img_url))
 
+    return children
+
+
+def append_blocks(page_id, children, label="画像ブロック"):
+    """
+    作成済みのページ（page_id）の本文にブロックを追加する。成功時は 0、失敗時は 1 を返す
+    """
+    if not page_id:
+        print(f"{label}追加エラー: ページが作成されていません。")
+        return 1
     if not children:
         print("[*]追加する画像がありません。")
         return 0
-
-    data = {"children": children}
-    response = requests.patch(url, headers=headers, json=data)
-    if response.status_code == 200:
-        print("[*]ヒアリングシート画像ブロックの追加に成功しました。")
-        return 0
-    else:
-        print(f"ヒアリングシート画像ブロック追加エラー: {response.text}")
+    try:
+        for i in range(0, len(children), MAX_BLOCKS_PER_REQUEST):
+            notion_client.append_children(page_id, children[i:i + MAX_BLOCKS_PER_REQUEST])
+    except NotionAPIError as e:
+        print(f"{label}追加エラー: {e}")
         return 1
+    print(f"[*]{label}の追加に成功しました。")
+    return 0
+
+
+def append_image_blocks(page_id, unique_id, card_image, hearing_images, card_url=None):
+    """
+    作成済みのページ（page_id）の本文に、外部画像URLを用いた画像ブロックを追加する関数です。
+    image_urls は追加する画像のURLのリスト。
+    card_url を指定した場合は、名刺画像にそのURL（キャッシュ済みのアップロード先など）を使う。
+    """
+    children = build_image_blocks(unique_id, card_image, hearing_images, card_url=card_url)
+    return append_blocks(page_id, children)
+
 
+def append_hearing_images_only(page_id, unique_id, hearing_images):
+    """
+    ヒアリングシート画像のみをページに追加する関数（手入力モード用）
+    """
+    children = build_image_blocks(unique_id, None, hearing_images)
+    return append_blocks(page_id, children, label="ヒアリングシート画像ブロック")
+
+
+def save_failed_lead(properties, children, page_id=None, error="", ambiguous=False):
+    """
+    Notion に送れなかったリードを保存する（page_id があればページ作成済みで画像追加のみ失敗）。
+    ambiguous はページ作成が Notion 側で処理されたか分からない失敗であることを表す
+    """
+    return dead_letters.add({"properties": properties, "children": children, "page_id": page_id, "ambiguous": ambiguous}, error)
+
+
+def replay_dead_letters(include_ambiguous=False):
+    """
+    保存済みのリードを再送する。成功したものは削除し、(成功件数, 失敗件数, 保留件数) を返す。
+    ページが作成済みか分からないリード（ambiguous）は二重作成を防ぐため再送せず保留にする。
+    データベースを確認して未作成だと分かった場合のみ include_ambiguous=True で再送する
+    """
+    succeeded, failed, held = 0, 0, 0
+    for entry in dead_letters.list():
+        page_id = entry.get("page_id")
+        if not page_id and entry.get("ambiguous") and not include_ambiguous:
+            print(f"[保留] ページ作成済みか不明なため再送しません（データベースを確認してください）: {entry['id']}")
+            held += 1
+            continue
+        if not page_id:
+            try:
+                page_id = create_notion_page(entry.get("properties") or {})
+            except NotionAPIError:
+                dead_letters.update(entry["id"], ambiguous=True)
+                failed += 1
+                continue
+            if not page_id:
+                failed += 1
+                continue
+            # ページ作成だけ成功した場合に二重作成しないよう記録しておく
+            dead_letters.update(entry["id"], page_id=page_id)
+        if append_blocks(page_id, entry.get("children") or []) != 0:
+            failed += 1
+            continue
+        dead_letters.remove(entry["id"])
+        succeeded += 1
+    print(f"[*]保存済みリードの再送: 成功 {succeeded} 件 / 失敗 {failed} 件 / 保留 {held} 件")
+    return succeeded, failed, held
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import contextlib
+import configparser
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:
+    # Windows ではプロセス間のロックは行わない（プロセス内のロックのみ）
+    fcntl = None
+
+config = configparser.ConfigParser()
+# 現在のスクリプトの場所を基準に設定ファイルのパスを決定
+config_path = os.path.join(os.path.dirname(__file__), "..", "..", "config.ini")
+config.read(config_path, encoding="utf-8")
+
+# 書き込みごとに fsync するか（always: 毎回ディスクに書き切る / never: OS に任せる）
+HANDOVER_FSYNC = config["HOST"].get("HANDOVER_FSYNC", "always").lower()
+# 引き継ぎデータの保持期間（時間、0 なら無期限。既存の環境で黙って削除しないよう省略時は無期限）と、期限切れを掃除する間隔（秒）
+HANDOVER_TTL_HOURS = float(config["HOST"].get("HANDOVER_TTL_HOURS", "0"))
+HANDOVER_SWEEP_INTERVAL = float(config["HOST"].get("HANDOVER_SWEEP_INTERVAL", "3600"))
+
+# 引き継ぎデータの保存先（1件 = 1 JSONファイル）と一覧用の索引
+HANDOVER_DIR = 'handovers'
+HANDOVER_INDEX_NAME = 'index.sqlite3'
+HANDOVER_LOCK_NAME = '.lock'
+
+# 書き込み途中で止まった一時ファイルを削除するまでの猶予（秒）
+STALE_TEMP_SECONDS = 600
+
+
+def is_valid_handover_id(handover_id: str) -> bool:
+    """
+    引き継ぎID（UUID v4）の形式かどうか
+    """
+    try:
+        uuid.UUID(handover_id, version=4)
+    except (ValueError, TypeError, AttributeError):
+        return False
+    return True
+
+
+class HandoverStore:
+    """
+    引き継ぎデータのストア。本体は従来どおり handovers/<id>.json に保存し、
+    一覧に必要な id・引き継ぎ元担当者・日時だけを SQLite の索引に持つ。
+    一覧表示はファイルを開かずに、日時の新しい順の索引検索（ページング付き）で返す。
+    書き込みは一時ファイル + rename で行い、複数プロセス（gunicorn のワーカーなど）の間はファイルロックで排他する。
+    """
+    def __init__(self, directory: str = HANDOVER_DIR):
+        self.directory = directory
+        self._db = None
+        self._reconciled = False
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._sweeper = None
+
+    @property
+    def _conn(self):
+        """
+        索引は最初に使うときに開く（画像変換のワーカープロセスなど、使わないプロセスでは開かない）
+        """
+        with self._open_lock:
+            if self._db is None:
+                os.makedirs(self.directory, exist_ok=True)
+                conn = sqlite3.connect(os.path.join(self.directory, HANDOVER_INDEX_NAME), timeout=10,
+                                       check_same_thread=False)
+                with conn:
+                    # 索引は WAL モードにして、書き込み中も他のプロセスから一覧を読めるようにする
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.executescript("""
+                        CREATE TABLE IF NOT EXISTS handovers (
+                            id TEXT PRIMARY KEY,
+                            source_tantosha TEXT,
+                            timestamp TEXT
+                        );
+                        CREATE INDEX IF NOT EXISTS idx_handovers_timestamp ON handovers(timestamp);
+                    """)
+                self._db = conn
+            return self._db
+
+    def _ensure_reconciled(self):
+        """
+        最初に一覧・掃除を行う前に一度だけ索引とファイルを突き合わせる
+        """
+        if self._reconciled:
+            return
+        with self._reconcile_lock:
+            if not self._reconciled:
+                self.reconcile()
+                self._reconciled = True
+
+    def _path(self, handover_id: str) -> str:
+        return os.path.join(self.directory, f"{handover_id}.json")
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """
+        プロセス内（スレッド間）とプロセス間の両方で排他するロック
+        """
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, HANDOVER_LOCK_NAME), 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_atomic(self, filepath: str, data: dict):
+        """
+        一時ファイルに書き出してから rename する。途中で落ちても中途半端なファイルは残らない
+        """
+        temp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+                if HANDOVER_FSYNC == "always":
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_path, filepath)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if HANDOVER_FSYNC == "always" and hasattr(os, "O_DIRECTORY"):
+            # rename をディスクに反映させるため、ディレクトリも fsync する
+            dir_fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    # --- 保存・取得・削除 ---
+    def save(self, data: dict) -> str:
+        """
+        引き継ぎデータを保存して ID を返す（handover_timestamp を付与する）
+        """
+        handover_id = str(uuid.uuid4())
+        data['handover_timestamp'] = datetime.now().isoformat()
+        filepath = self._path(handover_id)
+        with self._file_lock():
+            self._write_atomic(filepath, data)
+            self._index(handover_id, data)
+        print(f"Saved handover data to: {filepath}")
+        return handover_id
+
+    def get(self, handover_id: str):
+        """
+        引き継ぎデータを返す。見つからなければ None（壊れたファイルは json.JSONDecodeError）
+        """
+        filepath = self._path(handover_id)
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def delete(self, handover_id: str) -> bool:
+        """
+        引き継ぎデータを削除する。削除した場合は True、見つからなければ False
+        """
+        filepath = self._path(handover_id)
+        with self._file_lock():
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM handovers WHERE id = ?", (handover_id,))
+            if not os.path.exists(filepath):
+                return False
+            os.remove(filepath)
+        print(f"Deleted handover file: {filepath}")
+        return True
+
+    # --- 一覧 ---
+    def list(self, limit: int = 100, offset: int = 0) -> list:
+        """
+        日時の新しい順に id・引き継ぎ元担当者・日時を返す
+        """
+        self._ensure_reconciled()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, source_tantosha, timestamp FROM handovers ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+                (limit, offset),
+            ).fetchall()
+        return [{'id': row[0], 'source_tantosha': row[1], 'timestamp': row[2]} for row in rows]
+
+    def count(self) -> int:
+        self._ensure_reconciled()
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM handovers").fetchone()[0]
+
+    # --- 索引 ---
+    def _index(self, handover_id: str, data: dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO handovers (id, source_tantosha, timestamp) VALUES (?, ?, ?)",
+                (handover_id, data.get('handover_source_tantosha', '不明'), data.get('handover_timestamp')),
+            )
+
+    def reconcile(self):
+        """
+        起動時に索引とファイルを突き合わせる（索引導入前のファイルや、索引に載る前に止まった保存を取り込む）。
+        読めないファイルは <id>.json.corrupt に退避し、以降の一覧・掃除の対象から外す
+        """
+        with self._file_lock():
+            file_ids = {name[:-5] for name in os.listdir(self.directory)
+                        if name.endswith(".json") and is_valid_handover_id(name[:-5])}
+            with self._lock:
+                indexed_ids = {row[0] for row in self._conn.execute("SELECT id FROM handovers")}
+
+            for handover_id in file_ids - indexed_ids:
+                try:
+                    data = self.get(handover_id) or {}
+                    if not data.get('handover_timestamp'):
+                        # 日時のないファイルは更新日時で代用する（保持期間の判定に使うため）
+                        mtime = os.path.getmtime(self._path(handover_id))
+                        data['handover_timestamp'] = datetime.fromtimestamp(mtime).isoformat()
+                    self._index(handover_id, data)
+                except (OSError, json.JSONDecodeError) as e:
+                    print(f"Err reading {handover_id}.json: {e}")
+                    os.replace(self._path(handover_id), self._path(handover_id) + ".corrupt")
+
+            stale = indexed_ids - file_ids
+            if stale:
+                with self._lock, self._conn:
+                    self._conn.executemany("DELETE FROM handovers WHERE id = ?", [(i,) for i in stale])
+
+    # --- 期限切れの掃除 ---
+    def sweep(self, ttl_hours: float = HANDOVER_TTL_HOURS) -> int:
+        """
+        保持期間を過ぎた引き継ぎデータと、書き込み途中で残った一時ファイルを削除する。削除した件数を返す
+        """
+        self._ensure_reconciled()
+        removed = 0
+        with self._file_lock():
+            if ttl_hours > 0:
+                cutoff = (datetime.now() - timedelta(hours=ttl_hours)).isoformat()
+                with self._lock:
+                    expired = [row[0] for row in self._conn.execute(
+                        "SELECT id FROM handovers WHERE timestamp < ?", (cutoff,))]
+                for handover_id in expired:
+                    try:
+                        os.remove(self._path(handover_id))
+                    except FileNotFoundError:
+                        pass
+                    with self._lock, self._conn:
+                        self._conn.execute("DELETE FROM handovers WHERE id = ?", (handover_id,))
+                    removed += 1
+
+            now = time.time()
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith(".tmp") and now - os.path.getmtime(path) > STALE_TEMP_SECONDS:
+                    os.remove(path)
+
+            # WAL を索引本体に書き戻して小さく保つ
+            with self._lock:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        if removed:
+            print(f"[引き継ぎ] 保持期間を過ぎた引き継ぎデータを {removed} 件削除しました")
+        return removed
+
+    def start_sweeper(self, interval: float = HANDOVER_SWEEP_INTERVAL):
+        """
+        期限切れの掃除を定期的に行うスレッドを起動する（複数回呼んでも一度だけ実行）
+        """
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_loop, args=(interval,), name="handover-sweeper")
+            self._sweeper.daemon = True
+        self._sweeper.start()
+
+    def _sweep_loop(self, interval: float):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[引き継ぎ] 期限切れデータの掃除中にエラーが発生しました: {e}")
+            time.sleep(interval)
+
+
+# グローバルインスタンス
+handover_store = HandoverStore()
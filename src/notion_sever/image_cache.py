@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import configparser
+from collections import OrderedDict
+
+config = configparser.ConfigParser()
+# 現在のスクリプトの場所を基準に設定ファイルのパスを決定
+config_path = os.path.join(os.path.dirname(__file__), "..", "..", "config.ini")
+config.read(config_path, encoding="utf-8")
+
+# キャッシュの上限件数と有効期間（時間）
+IMAGE_CACHE_MAX_ENTRIES = int(config["HOST"].get("IMAGE_CACHE_MAX_ENTRIES", "1000"))
+IMAGE_CACHE_TTL_HOURS = float(config["HOST"].get("IMAGE_CACHE_TTL_HOURS", "72"))
+
+CACHE_DIR = 'cache'
+IMAGE_CACHE_PATH = os.path.join(CACHE_DIR, 'image_cache.json')
+
+
+def digest_file(path: str) -> str:
+    """
+    変換済みJPEGの内容から SHA-256 のハッシュ値を求める（同じ画像の再送信を見分けるキー）
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ImageCache:
+    """
+    画像のハッシュ値をキーに、アップロード先URLとOCR結果を保存するキャッシュ。
+    件数上限（古く使われていないものから削除）と有効期限を持ち、JSONファイルに保存して再起動後も使う。
+    """
+    def __init__(self, path: str = IMAGE_CACHE_PATH, max_entries: int = IMAGE_CACHE_MAX_ENTRIES,
+                 ttl_hours: float = IMAGE_CACHE_TTL_HOURS):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_hours * 3600
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        # ファイルは最初に使うときに読み込む（画像変換のワーカープロセスなど、使わないプロセスでは読まない）
+        self._loaded = False
+
+    def get(self, digest: str):
+        """
+        キャッシュされたエントリ（card_url, ocr）を返す。なければ None
+        """
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._entries.get(digest)
+            if entry is not None and self._is_expired(entry):
+                del self._entries[digest]
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(digest)
+            return dict(entry)
+
+    def put(self, digest: str, **fields):
+        """
+        エントリを追加・更新する（card_url=..., ocr=... のように指定）
+        """
+        with self._lock:
+            self._ensure_loaded()
+            entry = dict(self._entries.pop(digest, {}))
+            entry.update(fields)
+            entry.setdefault("created_at", time.time())
+            self._entries[digest] = entry
+            self._evict()
+            self._save()
+
+    def invalidate(self, digest: str):
+        with self._lock:
+            self._ensure_loaded()
+            if self._entries.pop(digest, None) is not None:
+                self._save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._ensure_loaded()
+            total = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 3) if total else 0.0,
+            }
+
+    def _is_expired(self, entry: dict) -> bool:
+        return time.time() - entry.get("created_at", 0) > self.ttl_seconds
+
+    def _evict(self):
+        for digest in [d for d, e in self._entries.items() if self._is_expired(e)]:
+            del self._entries[digest]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._loaded = True
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._entries = OrderedDict(data.get("entries", []))
+            self._hits = data.get("hits", 0)
+            self._misses = data.get("misses", 0)
+            self._evict()
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"[キャッシュ] 画像キャッシュの読み込みに失敗しました（空で開始します）: {e}")
+            self._entries = OrderedDict()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp"
+        data = {"hits": self._hits, "misses": self._misses, "entries": list(self._entries.items())}
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, self.path)
+
+
+# グローバルインスタンス
+image_cache = ImageCache()
@@ -0,0 +1,145 @@
+import os
+import shutil
+import threading
+import configparser
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+config = configparser.ConfigParser()
+# 現在のスクリプトの場所を基準に設定ファイルのパスを決定
+config_path = os.path.join(os.path.dirname(__file__), "..", "..", "config.ini")
+config.read(config_path, encoding="utf-8")
+
+# アップロード画像をメモリ上に保持する上限（これを超えた分は一時ファイルに退避する）
+UPLOAD_MEMORY_THRESHOLD = int(config["HOST"].get("UPLOAD_MEMORY_THRESHOLD_KB", "2048")) * 1024
+
+# 画像の正規化（デコード・リサイズ・JPEG変換）を行うプロセス数
+IMAGE_WORKERS = int(config["HOST"].get("IMAGE_WORKERS", "2"))
+
+# 正規化前の受信データの保存先（変換後のパスにこの接尾辞を付ける）
+RAW_SUFFIX = ".raw"
+
+
+def convert_to_jpeg(src_path, dest_path):
+    """画像をJPEG形式に変換・リサイズして保存し、書き込んだバイト数を返す（src_path はファイルオブジェクトでもよい）"""
+    temp_path = dest_path + ".tmp"
+    try:
+        with Image.open(src_path) as img:
+            img = img.convert("RGB")
+            try:
+                img.thumbnail((512, 512), Image.Resampling.LANCZOS)
+            except AttributeError:
+                img.thumbnail((512, 512), Image.LANCZOS)
+            img.save(temp_path, format="JPEG", quality=85)
+        os.replace(temp_path, dest_path)
+        print(f"Converted image to {dest_path}")
+        return os.path.getsize(dest_path)
+    except Exception as e:
+        print(f"Error converting {src_path} to JPEG: {e}")
+        if os.path.exists(temp_path):
+            try: os.remove(temp_path)
+            except OSError: pass
+        raise e
+
+
+def normalize_raw(raw_path, dest_path):
+    """
+    保存済みの受信データを JPEG に正規化し、成功したら受信データを削除する（プロセスプールで実行）
+    """
+    written = convert_to_jpeg(raw_path, dest_path)
+    os.remove(raw_path)
+    return written
+
+
+class ImageNormalizer:
+    """
+    アップロード画像の正規化をプロセスプールで並列に行う。
+    リクエストでは受信データを保存して投入するだけにし、処理側は wait() で変換後の画像を待つ。
+    """
+    def __init__(self, workers: int = IMAGE_WORKERS):
+        self.workers = max(1, workers)
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # スレッドを持つ親プロセスを fork しないよう forkserver（Windows では spawn）で起動する。
+                # forkserver には画像変換に必要なこのモジュールだけを読み込ませておく。
+                # ワーカーは起動スクリプト（sever.py）を __mp_main__ として読み込み直すため、
+                # 起動スクリプトから読み込むストア類は最初に使うときに開くようにしてある
+                if "forkserver" in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context("forkserver")
+                    context.set_forkserver_preload([__name__])
+                else:
+                    context = multiprocessing.get_context("spawn")
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._executor
+
+    def ingest(self, file_storage, dest_path):
+        """
+        受信データを一度だけディスクに書き出して正規化を投入し、書き込んだバイト数を返す
+        """
+        raw_path = dest_path + RAW_SUFFIX
+        stream = file_storage.stream
+        stream.seek(0)
+        with open(raw_path, 'wb') as f:
+            shutil.copyfileobj(stream, f, 1024 * 1024)
+            f.flush()
+            os.fsync(f.fileno())
+        written = os.path.getsize(raw_path)
+        self.submit(raw_path, dest_path)
+        return written
+
+    def submit(self, raw_path, dest_path):
+        future = self._get_executor().submit(normalize_raw, raw_path, dest_path)
+        with self._lock:
+            self._pending[os.path.abspath(dest_path)] = future
+        return future
+
+    def wait(self, dest_path) -> bool:
+        """
+        dest_path の変換が終わるまで待つ。変換済み（または変換できた）なら True。
+        再起動などで投入した変換が失われていても、受信データが残っていれば変換し直す
+        """
+        if not dest_path:
+            return False
+        dest_path = os.path.abspath(dest_path)
+        with self._lock:
+            future = self._pending.pop(dest_path, None)
+        if future is None and not os.path.exists(dest_path) and os.path.exists(dest_path + RAW_SUFFIX):
+            future = self.submit(dest_path + RAW_SUFFIX, dest_path)
+            with self._lock:
+                self._pending.pop(dest_path, None)
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"[画像変換] {dest_path} の変換に失敗しました: {e}")
+                raw_path = dest_path + RAW_SUFFIX
+                if os.path.exists(raw_path):
+                    try: os.remove(raw_path)
+                    except OSError: pass
+                return False
+        return os.path.exists(dest_path)
+
+
+def check_image(file_storage):
+    """
+    アップロードされたファイルが画像として読めるか（ヘッダーのみ）を確認する。読めなければ ValueError
+    """
+    stream = file_storage.stream
+    try:
+        stream.seek(0)
+        with Image.open(stream) as img:
+            img.verify()
+    except Exception as e:
+        raise ValueError(f"画像ファイルとして読み込めません: {file_storage.filename}") from e
+    finally:
+        stream.seek(0)
+
+
+# グローバルインスタンス
+image_normalizer = ImageNormalizer()
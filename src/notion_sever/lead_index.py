@@ -0,0 +1,221 @@
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+import configparser
+from datetime import datetime
+
+from notion_api import notion_client, NotionAPIError
+
+config = configparser.ConfigParser()
+# 現在のスクリプトの場所を基準に設定ファイルのパスを決定
+config_path = os.path.join(os.path.dirname(__file__), "..", "..", "config.ini")
+config.read(config_path, encoding="utf-8")
+
+DATABASE_ID = config["HOST"]["DATABASE_ID"]
+
+# 重複リードの扱い: create（従来どおり新規作成）/ merge（既存ページに追記）/ skip（何もしない）
+DUPLICATE_LEAD_MODE = config["HOST"].get("DUPLICATE_LEAD_MODE", "create").lower()
+
+LEAD_INDEX_PATH = os.path.join('cache', 'leads.sqlite3')
+
+# 会社名の比較で無視する法人格の表記
+COMPANY_SUFFIXES = ("株式会社", "有限会社", "合同会社", "(株)", "(有)", "㈱", "㈲")
+
+
+def normalize_email(email: str) -> str:
+    return (email or "").strip().lower()
+
+
+def normalize_phone(phone: str) -> str:
+    """
+    数字だけを残す（+81 から始まる番号は国内表記の 0 始まりにそろえる）
+    """
+    digits = re.sub(r"\D", "", unicodedata.normalize("NFKC", phone or ""))
+    if digits.startswith("81") and (phone or "").strip().startswith("+"):
+        digits = "0" + digits[2:]
+    return digits
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", "", text).lower()
+
+
+def normalize_company_name(company: str, name: str) -> str:
+    """
+    会社名（法人格を除く）と氏名を組み合わせたキー。どちらかが空なら空文字
+    """
+    company = normalize_text(company)
+    for suffix in COMPANY_SUFFIXES:
+        company = company.replace(normalize_text(suffix), "")
+    name = normalize_text(name)
+    if not company or not name:
+        return ""
+    return f"{company}/{name}"
+
+
+def lead_keys(analysis_result: dict) -> dict:
+    """
+    OCR結果（または手入力データ）から重複判定用のキーを作る
+    """
+    analysis_result = analysis_result or {}
+    return {
+        "email": normalize_email(analysis_result.get("Eメール", "")),
+        "phone": normalize_phone(analysis_result.get("電話番号", "")),
+        "name": normalize_text(analysis_result.get("担当者氏名", "")),
+        "company_name": normalize_company_name(analysis_result.get("会社名", ""), analysis_result.get("担当者氏名", "")),
+    }
+
+
+class LeadIndex:
+    """
+    作成済みリードのローカル索引（SQLite）。メール・電話番号+氏名・会社名+氏名で既存ページを引く。
+    名刺の電話番号は会社の代表番号のことが多いため、電話番号だけでは同一人物とみなさない。
+    自分で作成したページと、Notion データベースからの差分同期の両方で更新する。
+    """
+    def __init__(self, path: str = LEAD_INDEX_PATH):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+
+    @property
+    def _conn(self):
+        """
+        索引は最初に使うときに開く（画像変換のワーカープロセスなど、使わないプロセスでは開かない）
+        """
+        with self._open_lock:
+            if self._db is None:
+                self._db = self._open()
+            return self._db
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        with conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS leads (
+                    page_id TEXT PRIMARY KEY,
+                    email TEXT,
+                    phone TEXT,
+                    company_name TEXT,
+                    last_edited_time TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_leads_email ON leads(email);
+                CREATE INDEX IF NOT EXISTS idx_leads_phone ON leads(phone);
+                CREATE INDEX IF NOT EXISTS idx_leads_company_name ON leads(company_name);
+                CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT);
+            """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(leads)")}
+            if "name" not in columns:
+                # 氏名の列を追加した索引は、次回の同期で Notion から全件取り込み直す
+                conn.execute("ALTER TABLE leads ADD COLUMN name TEXT")
+                conn.execute("DELETE FROM sync_state WHERE key = 'last_edited_time'")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_leads_phone_name ON leads(phone, name)")
+        return conn
+
+    def find_duplicate(self, analysis_result: dict):
+        """
+        既存リードの page_id を返す（メール → 電話番号+氏名 → 会社名+氏名 の順に照合）。なければ None
+        """
+        keys = lead_keys(analysis_result)
+        with self._lock:
+            for columns in (("email",), ("phone", "name"), ("company_name",)):
+                if not all(keys[column] for column in columns):
+                    continue
+                where = " AND ".join(f"{column} = ?" for column in columns)
+                row = self._conn.execute(
+                    f"SELECT page_id FROM leads WHERE {where} LIMIT 1", tuple(keys[column] for column in columns)
+                ).fetchone()
+                if row:
+                    return row[0]
+        return None
+
+    def record(self, page_id: str, analysis_result: dict, last_edited_time: str = None):
+        keys = lead_keys(analysis_result)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO leads (page_id, email, phone, name, company_name, last_edited_time) VALUES (?, ?, ?, ?, ?, ?)",
+                (page_id, keys["email"] or None, keys["phone"] or None, keys["name"] or None, keys["company_name"] or None,
+                 last_edited_time or datetime.now().isoformat()),
+            )
+
+    def _get_state(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key: str, value: str):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+    def sync_from_notion(self) -> int:
+        """
+        前回の同期以降に編集されたページだけを Notion データベースから取得して索引に反映する
+        """
+        watermark = self._get_state("last_edited_time")
+        payload = {
+            "sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}],
+            "page_size": 100,
+        }
+        if watermark:
+            payload["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": watermark}}
+
+        synced = 0
+        while True:
+            data = notion_client.request("POST", f"databases/{DATABASE_ID}/query", payload)
+            for page in data.get("results", []):
+                self.record(page["id"], page_to_lead(page), page.get("last_edited_time"))
+                watermark = max(watermark or "", page.get("last_edited_time", ""))
+                synced += 1
+            # ページごとに進捗を保存し、途中で止まっても続きから同期できるようにする
+            if watermark:
+                self._set_state("last_edited_time", watermark)
+            if not data.get("has_more"):
+                break
+            payload["start_cursor"] = data.get("next_cursor")
+
+        print(f"[リード索引] Notion から {synced} 件を同期しました")
+        return synced
+
+    def start_sync(self):
+        """
+        差分同期をバックグラウンドで実行する
+        """
+        def run():
+            try:
+                self.sync_from_notion()
+            except NotionAPIError as e:
+                print(f"[リード索引] Notion からの同期に失敗しました: {e}")
+
+        thread = threading.Thread(target=run, name="lead-index-sync")
+        thread.daemon = True
+        thread.start()
+
+
+def _plain_text(prop: dict) -> str:
+    items = (prop or {}).get("title") or (prop or {}).get("rich_text") or []
+    return "".join(item.get("plain_text") or item.get("text", {}).get("content", "") for item in items)
+
+
+def page_to_lead(page: dict) -> dict:
+    """
+    Notion のページから、OCR結果と同じキーの辞書を作る
+    """
+    props = page.get("properties", {})
+    return {
+        "会社名": _plain_text(props.get("会社名")),
+        "担当者氏名": _plain_text(props.get("担当者氏名")),
+        "Eメール": (props.get("メール") or {}).get("email") or "",
+        "電話番号": (props.get("電話番号") or {}).get("phone_number") or "",
+    }
+
+
+# グローバルインスタンス
+lead_index = LeadIndex()
+
+
+if __name__ == "__main__":
+    lead_index.sync_from_notion()
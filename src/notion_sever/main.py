@@ -2,10 +2,15 @@ import os
 import sys
 from urllib.parse import urlparse
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 
 import ocr
 import pub_internet
+from image_cache import image_cache, digest_file
 import creteNotionPerties as cnp
+from notion_writer import notion_writer
+from notion_api import NotionAPIError
+from lead_index import lead_index, DUPLICATE_LEAD_MODE
 # import create_gmail as gm
 
 # 環境変数の設定
@@ -24,11 +29,61 @@ def remove_files(business_card_input, hearing_seed_inputs):
         os.remove("./uploads/" + os.path.basename(hearing_seed_input))
         
 
-def main(business_card_input, hearing_seed_inputs, lead_date_str, context):
+def report_progress(on_progress, stage, state="running"):
+    """
+    処理段階の状態を呼び出し元（バックグラウンド処理）へ通知する
+    """
+    if on_progress:
+        on_progress(stage, state)
+
+
+def report_checkpoint(on_checkpoint, **fields):
+    """
+    再開に必要な途中結果（作成したページなど）を呼び出し元へ通知する
+    """
+    if on_checkpoint:
+        on_checkpoint(**fields)
+
+
+def wait_hearing_upload(hearing_upload, on_progress):
+    """
+    ヒアリングシート画像のアップロード完了を待つ。失敗しても例外は送出せず False を返す
+    （ページ作成や後片付けは続け、画像ブロックは保存済みリードとして後から再送する）
+    """
+    try:
+        hearing_upload.result()
+    except Exception as e:
+        print(f"[アップロード] ヒアリングシート画像のアップロードに失敗しました: {e}")
+        report_progress(on_progress, "upload", "failed")
+        return False
+    report_progress(on_progress, "upload", "done")
+    return True
+
+
+def main(business_card_input, hearing_seed_inputs, lead_date_str, context, on_progress=None,
+         resume=None, on_checkpoint=None):
+        """
+        resume: 中断したジョブの途中結果（page_id, images_attached）。page_id があればページを作成し直さない
+        on_checkpoint(page_id=..., images_attached=...): ページ作成・画像追加が終わるたびに呼ばれる
+        """
         
         # 入力方法のチェック
         input_method = context.get('input_method', 'image')
-        
+
+        # ヒアリングシートのアップロードは OCR・Notion ページ作成と並行して進める
+        hearing_uploader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hearing-upload")
+        try:
+            return _run_pipeline(business_card_input, hearing_seed_inputs, lead_date_str, context,
+                                 input_method, hearing_uploader, on_progress, resume or {}, on_checkpoint)
+        finally:
+            hearing_uploader.shutdown(wait=True)
+
+
+def _run_pipeline(business_card_input, hearing_seed_inputs, lead_date_str, context, input_method,
+                  hearing_uploader, on_progress, resume, on_checkpoint):
+        hearing_upload = None
+        card_url = None
+
         if input_method == 'manual':
             # 手入力モード: OCRをスキップして手入力データを使用
             manual_data = context.get('manual_data', {})
@@ -41,20 +96,56 @@ def main(business_card_input, hearing_seed_inputs, lead_date_str, context):
                 '電話番号': manual_data.get('manual_phone', '')
             }
             print("[手入力モード] OCRをスキップして手入力データを使用します")
+            report_progress(on_progress, "ocr", "skipped")
             
-            # ヒアリングシートがある場合のみアップロード
+            # ヒアリングシートがある場合のみアップロード（ページ作成と並行）
             if hearing_seed_inputs:
-                unique_id, remote_base = pub_internet.scp_upload_via_key(None, hearing_seed_inputs)
+                report_progress(on_progress, "upload")
+                unique_id = pub_internet.new_upload_id()
+                pub_internet.upload_card(unique_id, None)
+                hearing_upload = hearing_uploader.submit(pub_internet.upload_hearing_sheets, unique_id, hearing_seed_inputs)
             else:
                 unique_id = None
+                report_progress(on_progress, "upload", "skipped")
         else:
-            # 名刺画像モード: 従来の処理
-            # 0) リモートサーバに画像をアップロード
-            unique_id, remote_base = pub_internet.scp_upload_via_key(business_card_input, hearing_seed_inputs)
+            # 名刺画像モード
+            # 同じ名刺画像の再送信なら、アップロード済みのURLとOCR結果を使い回す
+            card_digest = digest_file(business_card_input)
+            cached = image_cache.get(card_digest)
+            cached_ocr = cached.get("ocr") if cached else None
+
+            # インラインモードでは、ローカルの画像でアップロードより先に OCR を始める
+            ocr_future = None
+            if not cached_ocr and ocr.OCR_INLINE_IMAGE:
+                report_progress(on_progress, "ocr")
+                ocr_future = ocr.submit_ocr_file(business_card_input)
+
+            # 0) 名刺画像だけを先にアップロードし、ヒアリングシートは裏で続ける
+            report_progress(on_progress, "upload")
+            unique_id = pub_internet.new_upload_id()
+            if cached and cached.get("card_url"):
+                print(f"[キャッシュ] 名刺画像はアップロード済みのものを使用します: {cached['card_url']}")
+                card_url = cached["card_url"]
+                pub_internet.upload_card(unique_id, None)
+            else:
+                card_url = UPLOAD_URL + unique_id + "/card/" + os.path.basename(business_card_input)
+                pub_internet.upload_card(unique_id, business_card_input)
+                image_cache.put(card_digest, card_url=card_url)
+            hearing_upload = hearing_uploader.submit(pub_internet.upload_hearing_sheets, unique_id, hearing_seed_inputs)
 
-            # 1) openAIでテキスト抽出
-            url = UPLOAD_URL + unique_id + "/card/" + os.path.basename(business_card_input)
-            analysis_result = ocr.ocr_image_from_url(url)
+            # 1) openAIでテキスト抽出（ヒアリングシートのアップロードと並行）
+            if cached_ocr:
+                print("[キャッシュ] OCR結果をキャッシュから取得しました", image_cache.stats())
+                analysis_result = cached_ocr
+            else:
+                if ocr_future is None:
+                    # URL モード: アップロードした公開URLを OpenAI に取得させる
+                    report_progress(on_progress, "ocr")
+                    ocr_future = ocr.ocr_service.submit(card_url)
+                analysis_result = ocr_future.result()
+                if analysis_result:
+                    image_cache.put(card_digest, ocr=analysis_result)
+            report_progress(on_progress, "ocr", "done")
 
         # 2) メール文面の組み立て
 
@@ -67,24 +158,102 @@ def main(business_card_input, hearing_seed_inputs, lead_date_str, context):
         # 3) notion に送るためのプロパティを組み立てる
         properties = cnp.build_notion_properties(analysis_result, lead_date_str, context)
 
-        # 4) Notion APIでページ作成
-        page_id = cnp.create_notion_page(properties)
-        
-        # 5) Notion APIで画像ブロック追加（手入力モードではスキップ）
-        if input_method == 'manual':
-            if unique_id and hearing_seed_inputs:
-                # ヒアリングシートのみ追加
-                rt = cnp.append_hearing_images_only(page_id, unique_id, hearing_seed_inputs)
+        # 4) Notion APIでページ作成（画像ブロックも同じリクエストで登録）
+        # ヒアリングシートのアップロードが終わっていれば一緒に、まだなら名刺画像だけで先に作成する
+        card_image = business_card_input if input_method == 'image' else None
+        hearing_ready = hearing_upload is None or hearing_upload.done()
+        hearing_failed = False
+        if hearing_upload is not None and hearing_ready:
+            hearing_failed = not wait_hearing_upload(hearing_upload, on_progress)
+        hearing_attached = hearing_ready and not hearing_failed
+        inline_hearing = hearing_seed_inputs if unique_id and hearing_attached else []
+        children = cnp.build_image_blocks(unique_id, card_image, inline_hearing, card_url=card_url)
+
+        # 既に登録済みのリード（別の担当者が読み取った名刺など）はローカル索引で判定する
+        created_page_id = resume.get("page_id")
+        duplicate_id = None
+        if DUPLICATE_LEAD_MODE != "create" and not created_page_id:
+            duplicate_id = lead_index.find_duplicate(analysis_result)
+        skipped = False
+        saved_failure = False
+        ambiguous = False
+
+        report_progress(on_progress, "notion_create")
+        if created_page_id:
+            # 中断前に作成済みのページ（名刺画像と、その時点で届いていたヒアリングシート画像は登録済み）
+            print(f"[再開] 作成済みのページ {created_page_id} を使用します（ページは作成し直しません）")
+            page_id = created_page_id
+            children = []
+            report_progress(on_progress, "notion_create", "skipped")
+        elif duplicate_id and DUPLICATE_LEAD_MODE == "skip":
+            print(f"[重複リード] 既存ページ {duplicate_id} と重複するため、ページを作成しません")
+            page_id = duplicate_id
+            skipped = True
+            report_progress(on_progress, "notion_create", "skipped")
+        elif duplicate_id:
+            print(f"[重複リード] 既存ページ {duplicate_id} に追加ヒアリングとして統合します")
+            merge_blocks = cnp.build_merge_blocks(context, lead_date_str)
+            children = merge_blocks + children
+            page_id = duplicate_id
+            if cnp.append_blocks(page_id, children, "追加ヒアリング") != 0:
+                pending = merge_blocks + cnp.build_image_blocks(unique_id, card_image, hearing_seed_inputs if unique_id else [], card_url=card_url)
+                cnp.save_failed_lead(properties, pending, page_id=page_id, error="既存ページへの統合に失敗しました")
+                saved_failure = True
+                children = []
+                page_id = None
             else:
-                rt = 0  # 画像なしの場合は成功として扱う
+                report_checkpoint(on_checkpoint, page_id=page_id, images_attached=hearing_attached)
+            report_progress(on_progress, "notion_create", "done" if page_id else "failed")
         else:
-            # 従来の処理（名刺とヒアリングシート両方）
-            rt = cnp.append_image_blocks(page_id, unique_id, business_card_input, hearing_seed_inputs)
+            try:
+                page_id = notion_writer.create_page(properties, children)
+            except NotionAPIError:
+                # Notion 側で作成済みかもしれないので、再送時に二重作成しないよう印を付けて保存する
+                page_id = None
+                ambiguous = True
+            if page_id:
+                lead_index.record(page_id, analysis_result)
+                report_checkpoint(on_checkpoint, page_id=page_id, images_attached=hearing_attached)
+            report_progress(on_progress, "notion_create", "done" if page_id else "failed")
+
+        # 5) 後から届いたヒアリングシート画像だけを追加する
+        if created_page_id:
+            hearing_pending = not resume.get("images_attached") and bool(unique_id and hearing_seed_inputs)
+        else:
+            hearing_pending = not hearing_ready
+        rt = 0 if page_id else 1
+        if hearing_failed and not skipped and not created_page_id:
+            # ヒアリングシート画像を付けずにページを作成したので、画像ブロックは後から再送できるように保存する
+            rt = 1
+        if hearing_pending:
+            report_progress(on_progress, "image_blocks")
+            if hearing_failed or not wait_hearing_upload(hearing_upload, on_progress):
+                if not skipped:
+                    rt = 1
+            elif page_id and not skipped:
+                rt = cnp.append_hearing_images_only(page_id, unique_id, hearing_seed_inputs)
+                if rt == 0:
+                    report_checkpoint(on_checkpoint, images_attached=True)
+            report_progress(on_progress, "image_blocks", "skipped" if skipped else "done" if rt == 0 else "failed")
+        elif children and not skipped:
+            report_progress(on_progress, "image_blocks", "done" if rt == 0 else "failed")
+        else:
+            report_progress(on_progress, "image_blocks", "skipped")
+
+        # Notion に送れなかったリードは、後から再送できるように保存する
+        if rt != 0 and not saved_failure:
+            if page_id:
+                pending = cnp.build_image_blocks(unique_id, None, hearing_seed_inputs)
+                cnp.save_failed_lead(properties, pending, page_id=page_id, error="画像ブロックの追加に失敗しました")
+            else:
+                children = cnp.build_image_blocks(unique_id, card_image, hearing_seed_inputs if unique_id else [], card_url=card_url)
+                cnp.save_failed_lead(properties, children, error="ページ作成に失敗しました", ambiguous=ambiguous)
 
         # 6) リモートサーバのフォルダを削除
         # pub_internet.delete_remote_folder(unique_id)
         
         # 7) upload ファイルの削除
+        report_progress(on_progress, "cleanup")
         print("upload files remove")
         if input_method == 'image' and business_card_input:
             remove_files(business_card_input, hearing_seed_inputs)
@@ -92,6 +261,7 @@ def main(business_card_input, hearing_seed_inputs, lead_date_str, context):
             # 手入力モードでヒアリングシートのみ削除
             for hearing_seed_input in hearing_seed_inputs:
                 os.remove("./uploads/" + os.path.basename(hearing_seed_input))
+        report_progress(on_progress, "cleanup", "done")
         
         if rt == 1:
             return 1
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import uuid
+import threading
+import configparser
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limit import TokenBucket, backoff_delay, retry_after_seconds
+
+config = configparser.ConfigParser()
+# 現在のスクリプトの場所を基準に設定ファイルのパスを決定
+config_path = os.path.join(os.path.dirname(__file__), "..", "..", "config.ini")
+config.read(config_path, encoding="utf-8")
+
+# Notion
+NOTION_API_TOKEN = config["HOST"]["NOTION_API_TOKEN"]
+NOTION_VERSION = config["HOST"]["NOTION_VERSION"]
+NOTION_BASE_URL = "https://api.notion.com/v1"
+
+# Notion API の平均リクエスト上限（3リクエスト/秒）
+NOTION_REQUESTS_PER_SECOND = 3
+NOTION_MAX_RETRIES = int(config["HOST"].get("NOTION_MAX_RETRIES", "5"))
+NOTION_TIMEOUT = (5, float(config["HOST"].get("NOTION_TIMEOUT", "30")))  # (接続, 読み込み) 秒
+NOTION_POOL_SIZE = 10
+
+# 再試行しても送れなかったリードの保存先
+DEAD_LETTER_DIR = 'dead_letters'
+
+# 再試行の対象とするステータス（レート制限・競合・サーバーエラー）
+RETRYABLE_STATUSES = (409, 429, 500, 502, 503, 504)
+# 処理されなかったことが確実なステータス（ページ作成のように再送すると重複するリクエストでも再試行してよい）
+NOT_PROCESSED_STATUSES = (409, 429)
+
+
+class NotionAPIError(Exception):
+    """
+    Notion API 呼び出しが（再試行後も）失敗したことを表す例外
+    """
+    def __init__(self, message, status_code=None, body=None, ambiguous=False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+        # Notion 側で処理されたかどうか分からない失敗（タイムアウト・5xx）
+        self.ambiguous = ambiguous
+
+
+class NotionClient:
+    """
+    Notion API クライアント。keep-alive の接続プールを使い回し、
+    プロセス全体で 3リクエスト/秒 の上限を守り、429・5xx は Retry-After を考慮して再試行する。
+    """
+    def __init__(self, token=NOTION_API_TOKEN, version=NOTION_VERSION,
+                 max_retries=NOTION_MAX_RETRIES, timeout=NOTION_TIMEOUT):
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=NOTION_POOL_SIZE, pool_maxsize=NOTION_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            "Notion-Version": version,
+        })
+        self.rate_limiter = TokenBucket(NOTION_REQUESTS_PER_SECOND * 60, burst=NOTION_REQUESTS_PER_SECOND)
+
+    def request(self, method: str, path: str, payload: dict = None, idempotent: bool = True) -> dict:
+        """
+        API を呼び出して JSON を返す。再試行しても失敗した場合は NotionAPIError を送出する。
+        idempotent=False（ページ作成など、再送すると重複するリクエスト）の場合は、
+        送信前の接続失敗と 409・429 だけを再試行し、タイムアウト・5xx など処理されたか分からない失敗では
+        再試行せずに ambiguous=True の NotionAPIError を送出する
+        """
+        url = f"{NOTION_BASE_URL}/{path.lstrip('/')}"
+        last_error = None
+        for attempt in range(1, self.max_retries + 1):
+            self.rate_limiter.acquire()
+            retry_after = None
+            try:
+                response = self.session.request(method, url, json=payload, timeout=self.timeout)
+            except requests.ConnectTimeout as e:
+                # 接続できていないのでリクエストは届いていない
+                last_error = NotionAPIError(f"Notion API 接続エラー: {e}")
+            except requests.RequestException as e:
+                last_error = NotionAPIError(f"Notion API 接続エラー: {e}", ambiguous=True)
+                if not idempotent:
+                    raise last_error
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                last_error = NotionAPIError(
+                    f"Notion API エラー ({response.status_code}): {response.text}",
+                    status_code=response.status_code, body=response.text,
+                    ambiguous=response.status_code >= 500,
+                )
+                if response.status_code not in RETRYABLE_STATUSES:
+                    raise last_error
+                if not idempotent and response.status_code not in NOT_PROCESSED_STATUSES:
+                    raise last_error
+                retry_after = retry_after_seconds(response.headers)
+
+            if attempt < self.max_retries:
+                delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                print(f"[Notion] {method} {path} 試行 {attempt}/{self.max_retries} 失敗。{delay:.1f} 秒後に再試行します: {last_error}")
+                time.sleep(delay)
+
+        raise last_error
+
+    def create_page(self, payload: dict) -> dict:
+        # 再送するとページが重複して作成されるため、処理されたか分からない失敗は再試行しない
+        return self.request("POST", "pages", payload, idempotent=False)
+
+    def append_children(self, block_id: str, children: list) -> dict:
+        return self.request("PATCH", f"blocks/{block_id}/children", {"children": children})
+
+
+class DeadLetterStore:
+    """
+    再試行しても Notion に送れなかったリードを1件1ファイルで保存し、後から再送できるようにする
+    """
+    def __init__(self, directory: str = DEAD_LETTER_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def add(self, lead: dict, error: str) -> str:
+        letter_id = str(uuid.uuid4())
+        entry = dict(lead, id=letter_id, error=error, created_at=datetime.now().isoformat())
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{letter_id}.json")
+        with self._lock:
+            with open(path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False, indent=2)
+            os.replace(path + ".tmp", path)
+        print(f"[Notion] 送信できなかったリードを保存しました: {path}")
+        return letter_id
+
+    def list(self) -> list:
+        if not os.path.exists(self.directory):
+            return []
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), 'r', encoding='utf-8') as f:
+                    entries.append(json.load(f))
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"[Notion] 保存済みリードの読み込みに失敗しました ({filename}): {e}")
+        entries.sort(key=lambda e: e.get("created_at", ""))
+        return entries
+
+    def update(self, letter_id: str, **fields):
+        path = os.path.join(self.directory, f"{letter_id}.json")
+        with self._lock:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            entry.update(fields)
+            with open(path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False, indent=2)
+            os.replace(path + ".tmp", path)
+
+    def remove(self, letter_id: str):
+        path = os.path.join(self.directory, f"{letter_id}.json")
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# プロセス全体で共有するクライアントと保存先
+notion_client = NotionClient()
+dead_letters = DeadLetterStore()
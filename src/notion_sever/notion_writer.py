@@ -0,0 +1,151 @@
+import os
+import time
+import asyncio
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+import creteNotionPerties as cnp
+from notion_api import NotionAPIError
+
+config = configparser.ConfigParser()
+# 現在のスクリプトの場所を基準に設定ファイルのパスを決定
+config_path = os.path.join(os.path.dirname(__file__), "..", "..", "config.ini")
+config.read(config_path, encoding="utf-8")
+
+# 同時に実行する Notion ページ作成の数（リクエスト数の上限は NotionClient 側で全体共通に守る）
+NOTION_WRITER_CONCURRENCY = int(config["HOST"].get("NOTION_WRITER_CONCURRENCY", "3"))
+
+# 書き込み時間の平均を出すために保持する直近の件数
+LATENCY_WINDOW = 100
+
+
+class NotionWriter:
+    """
+    全ワーカーからのページ作成を1つのキューで受け付け、受け付け順に、
+    同時実行数を制限しながら Notion に書き込む非同期サービス。
+    各ワーカーが個別に api.notion.com に殺到して 429 を奪い合うのを防ぐ。
+    """
+    def __init__(self, concurrency: int = NOTION_WRITER_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self._loop = None
+        self._thread = None
+        self._queue = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._queued = 0
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._wait_seconds = []
+        self._write_seconds = []
+
+    def start(self):
+        """
+        イベントループスレッドとディスパッチャーを起動する（複数回呼んでも一度だけ実行）
+        """
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="notion-writer")
+            thread = threading.Thread(target=loop.run_forever, name="notion-writer-loop")
+            thread.daemon = True
+            thread.start()
+            asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+            self._loop = loop
+            self._thread = thread
+
+    async def _setup(self):
+        self._queue = asyncio.Queue()
+        asyncio.get_running_loop().create_task(self._dispatch())
+
+    def submit(self, properties: dict, children: list = None):
+        """
+        ページ作成を投入し、page_id（失敗時は None）を返す concurrent.futures.Future を返す。
+        作成されたか分からない失敗では、Future は NotionAPIError（ambiguous）を送出する
+        """
+        self.start()
+        with self._metrics_lock:
+            self._queued += 1
+        return asyncio.run_coroutine_threadsafe(self._enqueue(properties, children), self._loop)
+
+    def create_page(self, properties: dict, children: list = None):
+        """
+        同期版：ページ作成を投入して完了を待ち、page_id（失敗時は None）を返す
+        """
+        return self.submit(properties, children).result()
+
+    async def _enqueue(self, properties, children):
+        done = asyncio.get_running_loop().create_future()
+        await self._queue.put((time.monotonic(), properties, children, done))
+        return await done
+
+    async def _dispatch(self):
+        """
+        キューに溜まっている分をまとめて取り出し、受け付け順に書き込みを開始する
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            for item in batch:
+                await semaphore.acquire()
+                asyncio.get_running_loop().create_task(self._write(item, semaphore))
+
+    async def _write(self, item, semaphore):
+        enqueued_at, properties, children, done = item
+        started = time.monotonic()
+        with self._metrics_lock:
+            self._queued -= 1
+            self._in_flight += 1
+        page_id = None
+        error = None
+        try:
+            page_id = await asyncio.get_running_loop().run_in_executor(
+                self._executor, cnp.create_notion_page, properties, children
+            )
+        except NotionAPIError as e:
+            # 作成されたか分からない失敗は呼び出し元に伝え、再送せずに保留させる
+            error = e
+        except Exception as e:
+            print(f"[Notion書き込み] ページ作成中にエラーが発生しました: {e}")
+        finally:
+            finished = time.monotonic()
+            with self._metrics_lock:
+                self._in_flight -= 1
+                if page_id:
+                    self._completed += 1
+                else:
+                    self._failed += 1
+                self._wait_seconds = (self._wait_seconds + [started - enqueued_at])[-LATENCY_WINDOW:]
+                self._write_seconds = (self._write_seconds + [finished - started])[-LATENCY_WINDOW:]
+            semaphore.release()
+            if not done.done():
+                if error is not None:
+                    done.set_exception(error)
+                else:
+                    done.set_result(page_id)
+
+    def metrics(self) -> dict:
+        """
+        キューの深さと書き込み時間（直近の平均）を返す
+        """
+        def average(values):
+            return round(sum(values) / len(values), 3) if values else 0.0
+
+        with self._metrics_lock:
+            return {
+                "queue_depth": self._queued,
+                "in_flight": self._in_flight,
+                "completed": self._completed,
+                "failed": self._failed,
+                "avg_wait_seconds": average(self._wait_seconds),
+                "avg_write_seconds": average(self._write_seconds),
+            }
+
+
+# プロセス全体で共有する書き込みサービス
+notion_writer = NotionWriter()
@@ -2,9 +2,15 @@ import requests
 import json
 import configparser
 import os
+import base64
 import asyncio
-from openai import AsyncOpenAI
+import threading
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from openai import OpenAI
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+
+from rate_limit import TokenBucket, CircuitBreaker, CircuitBreakerOpen, backoff_delay, retry_after_seconds
 
 config = configparser.ConfigParser()
 # 現在のスクリプトの場所を基準に設定ファイルのパスを決定
@@ -18,15 +24,103 @@ MODEL = "gpt-4o"
 # 画像アップロード用のURL
 UPLOAD_URL = config["HOST"]["UPLOAD_URL"]
 
+# true の場合、名刺画像をアップロードせず base64 のデータURLとして直接 OCR に送る（省略時は公開URL経由）
+OCR_INLINE_IMAGE = config["HOST"].get("OCR_INLINE_IMAGE", "false").lower() in ["true", "1", "t"]
+
+# OpenAI への同時接続数の上限と、使っていない接続を保持する秒数
+OCR_MAX_CONNECTIONS = int(config["HOST"].get("OCR_MAX_CONNECTIONS", "10"))
+OCR_KEEPALIVE_EXPIRY = 60.0
+
+# 全ワーカー共通の OpenAI 利用上限（1分あたり）と、OCR 1回あたりの推定トークン数
+OPENAI_RPM = float(config["HOST"].get("OPENAI_RPM", "500"))
+OPENAI_TPM = float(config["HOST"].get("OPENAI_TPM", "30000"))
+OCR_ESTIMATED_TOKENS = 1500
+OCR_BACKOFF_BASE = 1.0  # 再試行の待機秒数の基準（試行ごとに倍、ランダムなゆらぎ付き）
+
+# 連続で失敗したら一定時間 OCR を止めるサーキットブレーカーの設定
+OCR_BREAKER_THRESHOLD = int(config["HOST"].get("OCR_BREAKER_THRESHOLD", "5"))
+OCR_BREAKER_COOLDOWN = float(config["HOST"].get("OCR_BREAKER_COOLDOWN", "60"))
+
+ocr_request_bucket = TokenBucket(OPENAI_RPM)
+ocr_token_bucket = TokenBucket(OPENAI_TPM)
+ocr_breaker = CircuitBreaker("OCR", OCR_BREAKER_THRESHOLD, OCR_BREAKER_COOLDOWN)
+
+
+class OCRService:
+    """
+    OCR 処理を専用のイベントループスレッドで実行するサービス。
+    AsyncOpenAI クライアント（HTTP接続プール）を1つだけ作って使い回すため、
+    リードごとに TLS 接続を張り直さずに済む。どのスレッドからでも submit できる。
+    """
+    def __init__(self, api_key=OPENAI_API_KEY, max_connections=OCR_MAX_CONNECTIONS):
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self._loop = None
+        self._thread = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        イベントループスレッドとクライアントを起動する（複数回呼んでも一度だけ実行）
+        """
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="ocr-event-loop")
+            thread.daemon = True
+            thread.start()
+            # クライアントはループ上で作成し、そのループでだけ使う
+            self._client = asyncio.run_coroutine_threadsafe(self._create_client(), loop).result()
+            self._loop = loop
+            self._thread = thread
+
+    async def _create_client(self):
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=OCR_KEEPALIVE_EXPIRY,
+            )
+        )
+        # 再試行とバックオフは ocr_image_from_url_async 側で行うため、SDK の自動リトライは無効にする
+        return AsyncOpenAI(api_key=self.api_key, http_client=http_client, max_retries=0)
+
+    def submit(self, image_url, max_retries=5):
+        """
+        OCR を投入し、結果の辞書を返す concurrent.futures.Future を返す
+        """
+        return self.run(lambda client: ocr_image_from_url_async(image_url, max_retries, client=client))
+
+    def run(self, make_coroutine):
+        """
+        make_coroutine(client) が返すコルーチンを共有ループで実行し、Future を返す
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(make_coroutine(self._client), self._loop)
 
-async def ocr_image_from_url_async(image_url, max_retries=5) -> dict:
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._client.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = self._thread = self._client = None
+
+
+async def ocr_image_from_url_async(image_url, max_retries=5, client=None) -> dict:
     """
     非同期版：指定した画像の公開URLから、GPTにOCR解析を依頼し、
     抽出されたテキストを、階層構造を持たない単純なJSON形式で返す関数です。
     最大5回まで再試行します。
+    client を省略した場合は呼び出しごとにクライアントを作成します（OCRService 経由なら共有クライアント）。
     """
 
-    client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    if client is None:
+        client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
     content = """ 
     これは名刺の画像です。会社名、業種、部署、役職、担当者氏名、住所、正式部署名、役職区分、住所の都道府県、電話番号、携帯番号、Eメール、郵便番号の情報を有効なJSON形式のみで返してください。ただし、業種、部署、役職は以下のリストから一つ選択してください。
@@ -48,8 +142,22 @@ async def ocr_image_from_url_async(image_url, max_retries=5) -> dict:
         [部長, 本部長, 事務部長, 不明, 一般社員, 課長, シニアエキスパート, 役員・理事, 代表取締役, 係長(リーダー・班長), マネージャ, 副部長, フリーランス, 係長, 課長代理, 主任]"""
             
     for attempt in range(1, max_retries + 1):
+        # 上流が停止中と判断されている間は待たずに諦める（ジョブを失敗扱いにして、後から再実行できるようにする）
         try:
-            print(f"[OCR] 試行 {attempt}/{max_retries}: {image_url}")
+            is_trial = ocr_breaker.before_call()
+        except CircuitBreakerOpen as e:
+            print(f"[エラー] {e}")
+            raise
+
+        # 全ワーカー共通の 1分あたりリクエスト数・トークン数の上限を守る
+        wait = max(ocr_request_bucket.reserve(1), ocr_token_bucket.reserve(OCR_ESTIMATED_TOKENS))
+        if wait > 0:
+            print(f"[OCR] レート制限のため {wait:.1f} 秒待機します")
+            await asyncio.sleep(wait)
+
+        retry_after = None
+        try:
+            print(f"[OCR] 試行 {attempt}/{max_retries}: {describe_image_url(image_url)}")
             
             response = await client.chat.completions.create(
                 model=MODEL,
@@ -66,6 +174,7 @@ async def ocr_image_from_url_async(image_url, max_retries=5) -> dict:
                     ],
                 }],
             )
+            ocr_breaker.record_success()
                
             response_text = response.choices[0].message.content
             print(f"[OCR] 試行 {attempt} レスポンス:", response_text[:100] + "..." if len(response_text) > 100 else response_text)
@@ -73,37 +182,36 @@ async def ocr_image_from_url_async(image_url, max_retries=5) -> dict:
             # GPTが拒否した場合の処理
             if "I'm sorry" in response_text or "I can't" in response_text or "cannot" in response_text.lower():
                 print(f"[警告] 試行 {attempt}: GPT-4oがリクエストを拒否しました。")
-                if attempt < max_retries:
-                    print("[リトライ] すぐに再試行します...")
-                    continue
-                else:
-                    print("[エラー] 最大試行回数に達しました。空のデータを返します。")
-                    return {}
-            
-            response_clean = remove_code_block_fences(response_text)
-            
-            # JSON形式の検証
-            try:
-                result = json.loads(response_clean)
-                print(f"[成功] 試行 {attempt}でOCR処理が完了しました。")
-                return result
-            except json.JSONDecodeError as je:
-                print(f"[警告] 試行 {attempt}: JSONパースエラー: {je}")
-                if attempt < max_retries:
-                    print("[リトライ] すぐに再試行します...")
-                    continue
-                else:
-                    print(f"[エラー] JSONパース失敗: {response_clean}")
-                    return {}
-        
+            else:
+                response_clean = remove_code_block_fences(response_text)
+                
+                # JSON形式の検証
+                try:
+                    result = json.loads(response_clean)
+                    print(f"[成功] 試行 {attempt}でOCR処理が完了しました。")
+                    return result
+                except json.JSONDecodeError as je:
+                    print(f"[警告] 試行 {attempt}: JSONパースエラー: {je}")
+                    print(f"[警告] 応答内容: {response_clean}")
+
+        except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) as e:
+            # レート制限・接続エラー・サーバーエラーは上流の状態として記録する
+            ocr_breaker.record_failure()
+            retry_after = retry_after_seconds(getattr(getattr(e, "response", None), "headers", None))
+            print(f"[エラー] 試行 {attempt}: {e}")
         except Exception as e:
             print(f"[エラー] 試行 {attempt}: {e}")
-            if attempt < max_retries:
-                print("[リトライ] すぐに再試行します...")
-                continue
-            else:
-                print("[エラー] 最大試行回数に達しました。空のデータを返します。")
-                return {}
+        finally:
+            if is_trial:
+                ocr_breaker.release_trial()
+
+        if attempt < max_retries:
+            delay = retry_after if retry_after is not None else backoff_delay(attempt, base=OCR_BACKOFF_BASE)
+            print(f"[リトライ] {delay:.1f} 秒後に再試行します...")
+            await asyncio.sleep(delay)
+
+    print("[エラー] 最大試行回数に達しました。空のデータを返します。")
+    return {}
 
 def remove_code_block_fences(s: str) -> str:
     """
@@ -117,29 +225,55 @@ def remove_code_block_fences(s: str) -> str:
     return "\n".join(lines).strip()
 
 
+def image_to_data_url(image_path: str) -> str:
+    """
+    ローカルの画像ファイルを base64 のデータURL（data:image/jpeg;base64,...）に変換する
+    """
+    with open(image_path, 'rb') as f:
+        encoded = base64.b64encode(f.read()).decode("ascii")
+    return f"data:image/jpeg;base64,{encoded}"
+
+
+def describe_image_url(image_url: str) -> str:
+    """
+    ログ出力用：データURLは中身を出さずにサイズだけ表示する
+    """
+    if image_url.startswith("data:"):
+        return f"インライン画像 ({len(image_url)} 文字)"
+    return image_url
+
+
 def ocr_image_from_url(image_url, max_retries=5) -> dict:
     """
-    同期版：既存のコードとの互換性のため残しておく
+    同期版：共有の OCRService に投入して結果を待つ（バックグラウンドのワーカースレッドから呼ばれる）
     """
-    try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            # 既に実行中のループがある場合は新しいタスクとして実行
-            return asyncio.run_coroutine_threadsafe(
-                ocr_image_from_url_async(image_url, max_retries), loop
-            ).result()
-        else:
-            return loop.run_until_complete(ocr_image_from_url_async(image_url, max_retries))
-    except RuntimeError:
-        # ループが取得できない場合は新しいループを作成
-        return asyncio.run(ocr_image_from_url_async(image_url, max_retries))
+    return ocr_service.submit(image_url, max_retries).result()
 
 
-async def ocr_multiple_images_async(image_urls, max_retries=5) -> list:
+def submit_ocr_file(image_path, max_retries=5):
+    """
+    ローカルの変換済みJPEGをデータURLとして OCR に投入し、Future を返す（アップロードを待たずに開始できる）
+    """
+    return ocr_service.submit(image_to_data_url(image_path), max_retries)
+
+
+async def ocr_multiple_images_async(image_urls, max_retries=5, concurrency=None, client=None, on_result=None) -> list:
     """
     複数の画像を並行処理でOCR解析する関数
+    concurrency を指定すると、同時に処理する件数をその数までに制限する。
+    on_result(index, result) は1件終わるごとに呼ばれる（途中経過の保存・進捗表示用）。
+    ファイルへの書き込みなどで共有ループを止めないよう、スレッドプールで実行する（複数スレッドから同時に呼ばれうる）
     """
-    tasks = [ocr_image_from_url_async(url, max_retries) for url in image_urls]
+    semaphore = asyncio.Semaphore(concurrency or max(len(image_urls), 1))
+
+    async def run(index, url):
+        async with semaphore:
+            result = await ocr_image_from_url_async(url, max_retries, client=client)
+        if on_result:
+            await asyncio.get_running_loop().run_in_executor(None, on_result, index, result)
+        return result
+
+    tasks = [run(i, url) for i, url in enumerate(image_urls)]
     results = await asyncio.gather(*tasks, return_exceptions=True)
     
     # 例外が発生した場合は空の辞書を返す
@@ -154,6 +288,10 @@ async def ocr_multiple_images_async(image_urls, max_retries=5) -> list:
     return processed_results
 
 
+# プロセス全体で共有する OCR サービス
+ocr_service = OCRService()
+
+
 if __name__ == "__main__":
     # 解析したい画像の公開URLを指定してください
     image_url = UPLOAD_URL + "sample.jpg"
@@ -1,5 +1,6 @@
-import uuid, os, paramiko
+import uuid, os, time, shlex, queue, threading, paramiko
 import configparser
+from contextlib import contextmanager
 
 config = configparser.ConfigParser()
 # 現在のスクリプトの場所を基準に設定ファイルのパスを決定
@@ -11,33 +12,243 @@ UPLORD_PATH = config["HOST"]["UPLOAD_PATH"]
 SERVER = config["HOST"]["SERVER"]
 USERNAME = config["HOST"]["USER"]
 
+# SSH接続プールの設定
+SSH_POOL_SIZE = int(config["HOST"].get("SSH_POOL_SIZE", "4"))  # 同時に使う接続数の上限
+SSH_KEEPALIVE = int(config["HOST"].get("SSH_KEEPALIVE", "30"))  # keepalive 送信間隔（秒）
+SSH_IDLE_TIMEOUT = int(config["HOST"].get("SSH_IDLE_TIMEOUT", "300"))  # これ以上使われていない接続は破棄（秒）
+
+# 複数ファイルを同時に送る SFTP チャネル数
+SFTP_UPLOAD_CHANNELS = int(config["HOST"].get("SFTP_UPLOAD_CHANNELS", "4"))
+
 
 def scp_upload_via_key(card_path, hearing_paths):
-    unique_id = uuid.uuid4().hex
-    remote_base = UPLORD_PATH + "/" + unique_id
-    remote_card_dir = remote_base + "/card"
-    remote_hearing_dir = remote_base + "/hearing"
+    unique_id = new_upload_id()
+    remote_base = upload_card(unique_id, card_path)
+    upload_hearing_sheets(unique_id, hearing_paths)
+
+    return unique_id, remote_base
+
+
+def new_upload_id():
+    return uuid.uuid4().hex
+
 
-    key = load_private_key(KEY_PATH)
+def _connect():
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=SERVER, username=USERNAME, pkey=key)
+    ssh.connect(hostname=SERVER, username=USERNAME, pkey=get_private_key())
+    ssh.get_transport().set_keepalive(SSH_KEEPALIVE)
+    return ssh
 
-    sftp = ssh.open_sftp()
-    for d in (remote_base, remote_card_dir, remote_hearing_dir):
+
+class PooledConnection:
+    """
+    プールで管理する SSH 接続と、その上で開いた SFTP セッション
+    """
+    def __init__(self):
+        self.ssh = _connect()
+        self._sftp = None
+        self.last_used = time.monotonic()
+
+    @property
+    def sftp(self):
+        if self._sftp is None:
+            self._sftp = self.ssh.open_sftp()
+        return self._sftp
+
+    def is_alive(self) -> bool:
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
         try:
-            sftp.mkdir(d)
-        except IOError:
-            pass
+            if self._sftp is not None:
+                self._sftp.close()
+            self.ssh.close()
+        except Exception as e:
+            print(f"[SSH] 接続のクローズに失敗しました: {e}")
 
-    sftp.put(card_path, f"{remote_card_dir}/{os.path.basename(card_path)}")
-    for local in hearing_paths:
-        sftp.put(local, f"{remote_hearing_dir}/{os.path.basename(local)}")
 
-    sftp.close()
-    ssh.close()
+class SSHConnectionPool:
+    """
+    SSH/SFTP 接続を使い回すためのスレッドセーフなプール。
+    同時に貸し出す接続数を max_size で制限し、切断済み・長時間未使用の接続は貸し出し時に作り直す。
+    """
+    def __init__(self, max_size: int = SSH_POOL_SIZE, idle_timeout: int = SSH_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._slots = threading.BoundedSemaphore(max(1, max_size))
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _checkout(self) -> PooledConnection:
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                return PooledConnection()
+            if conn.is_alive() and time.monotonic() - conn.last_used < self.idle_timeout:
+                return conn
+            conn.close()
+
+    def _checkin(self, conn: PooledConnection):
+        conn.last_used = time.monotonic()
+        with self._lock:
+            self._idle.append(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        接続を1つ借りる。処理中に接続が切れた場合はプールに戻さず破棄する
+        """
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except Exception:
+            if conn is not None and not conn.is_alive():
+                conn.close()
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(conn)
+            self._slots.release()
+
+    def run(self, operation):
+        """
+        operation(conn) を実行する。接続が切れて失敗した場合は新しい接続で一度だけ再試行する
+        """
+        try:
+            with self.connection() as conn:
+                return operation(conn)
+        except (FileNotFoundError, PermissionError):
+            # ファイル操作のエラー（存在しないパス等）は再試行しても解決しない
+            raise
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            print(f"[SSH] 接続エラーのため再接続して再試行します: {e}")
+            with self.connection() as conn:
+                return operation(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def upload_card(unique_id, card_path):
+    """
+    リモートのフォルダ一式を作成し、名刺画像だけを先にアップロードする
+    （OCRは名刺画像だけで開始できるため、ヒアリングシートより先に確定させる）
+    """
+    remote_base = UPLORD_PATH + "/" + unique_id
+    remote_card_dir = remote_base + "/card"
+    remote_hearing_dir = remote_base + "/hearing"
+
+    def upload(conn):
+        make_remote_dirs(conn, remote_card_dir, remote_hearing_dir)
+        if card_path:
+            return upload_files(conn, [(card_path, f"{remote_card_dir}/{os.path.basename(card_path)}")])
+        return []
+
+    ssh_pool.run(upload)
+
+    return remote_base
+
+
+def upload_hearing_sheets(unique_id, hearing_paths):
+    """
+    upload_card で作成済みのフォルダにヒアリングシート画像をアップロードする
+    """
+    if not hearing_paths:
+        return []
+
+    remote_hearing_dir = UPLORD_PATH + "/" + unique_id + "/hearing"
+    files = [(local, f"{remote_hearing_dir}/{os.path.basename(local)}") for local in hearing_paths]
+
+    return ssh_pool.run(lambda conn: upload_files(conn, files))
 
-    return unique_id, remote_base
+
+def make_remote_dirs(conn, *remote_dirs):
+    """
+    mkdir -p でフォルダ階層をまとめて作成する（SFTP の mkdir を階層ごとに往復させない）
+    """
+    command = "mkdir -p " + " ".join(shlex.quote(d) for d in remote_dirs)
+    stdin, stdout, stderr = conn.ssh.exec_command(command)
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        err = stderr.read().decode().strip()
+        raise RuntimeError(f"リモートフォルダ作成失敗 (exit {exit_status}): {err}")
+
+
+def upload_files(conn, files, channels: int = SFTP_UPLOAD_CHANNELS) -> list:
+    """
+    (ローカルパス, リモートパス) のリストをアップロードし、ファイルごとのバイト数と所要時間を返す。
+    複数ファイルの場合は同じ SSH 接続上に SFTP チャネルを複数開いて並行に送る。
+    """
+    if not files:
+        return []
+
+    channels = max(1, min(channels, len(files)))
+    if channels == 1:
+        results = [_put_file(conn.sftp, local, remote) for local, remote in files]
+    else:
+        pending = queue.Queue()
+        for item in files:
+            pending.put(item)
+        results = []
+        errors = []
+        results_lock = threading.Lock()
+
+        def send_all():
+            try:
+                sftp = conn.ssh.open_sftp()
+            except Exception as e:
+                with results_lock:
+                    errors.append(e)
+                return
+            try:
+                while True:
+                    try:
+                        local, remote = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    stats = _put_file(sftp, local, remote)
+                    with results_lock:
+                        results.append(stats)
+            except Exception as e:
+                with results_lock:
+                    errors.append(e)
+            finally:
+                sftp.close()
+
+        workers = [threading.Thread(target=send_all, name=f"sftp-upload-{i + 1}") for i in range(channels)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+
+    total_bytes = sum(r["bytes"] for r in results)
+    total_seconds = sum(r["seconds"] for r in results)
+    print(f"[SFTP] {len(results)} ファイル / {total_bytes} bytes をアップロードしました (チャネル数: {channels}, 合計 {total_seconds:.2f}s)")
+    return results
+
+
+def _put_file(sftp, local_path, remote_path) -> dict:
+    """
+    1ファイルを送る。putfo は書き込みの応答を待たずに次のチャンクを送り（pipelined）、
+    confirm=True で送信後にリモートのファイルサイズを確認する（一致しなければ IOError）
+    """
+    started = time.monotonic()
+    with open(local_path, 'rb') as src:
+        attrs = sftp.putfo(src, remote_path, confirm=True)
+    sent = attrs.st_size
+    elapsed = time.monotonic() - started
+    print(f"[SFTP] {os.path.basename(local_path)}: {sent} bytes, {elapsed:.2f}s")
+    return {"file": local_path, "remote_path": remote_path, "bytes": sent, "seconds": elapsed}
 
 
 
@@ -47,18 +258,15 @@ def delete_remote_folder(unique_id: str):
     """
 
     remote_base = UPLORD_PATH + unique_id
-    key = load_private_key(KEY_PATH)
-    
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=SERVER, username=USERNAME, pkey=key)
 
-    stdin, stdout, stderr = ssh.exec_command(f"rm -rf {remote_base}")
-    exit_status = stdout.channel.recv_exit_status()
-    ssh.close()
+    def remove(conn):
+        stdin, stdout, stderr = conn.ssh.exec_command(f"rm -rf {remote_base}")
+        exit_status = stdout.channel.recv_exit_status()
+        return exit_status, stderr.read().decode().strip()
+
+    exit_status, err = ssh_pool.run(remove)
 
     if exit_status != 0:
-        err = stderr.read().decode().strip()
         raise RuntimeError(f"リモート削除失敗 (exit {exit_status}): {err}")
     
 
@@ -76,4 +284,23 @@ def load_private_key(path: str):
         try:
             return cls.from_private_key_file(path)
         except (paramiko.SSHException, IOError):
-            continue
\ No newline at end of file
+            continue
+
+
+_private_key = None
+_private_key_lock = threading.Lock()
+
+
+def get_private_key():
+    """
+    秘密鍵は最初の接続時に一度だけ読み込む（画像変換のワーカープロセスなど、接続しないプロセスでは読まない）
+    """
+    global _private_key
+    with _private_key_lock:
+        if _private_key is None:
+            _private_key = load_private_key(KEY_PATH)
+        return _private_key
+
+
+# プロセス全体で共有する接続プール
+ssh_pool = SSHConnectionPool()
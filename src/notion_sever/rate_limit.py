@@ -0,0 +1,124 @@
+import time
+import random
+import threading
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """
+    指数バックオフ（full jitter）の待機秒数を返す。attempt は 1 始まり
+    """
+    return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
+
+
+def retry_after_seconds(headers) -> float:
+    """
+    レスポンスヘッダーの Retry-After（秒）/ retry-after-ms を読み取る。指定がなければ None
+    """
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        # HTTP日付形式などは無視して通常のバックオフに任せる
+        pass
+    return None
+
+
+class TokenBucket:
+    """
+    1分あたりの上限（リクエスト数・トークン数など）を守るためのトークンバケット。
+    スレッドセーフで、reserve() は必要な待機秒数を返すだけなので同期・非同期どちらからも使える。
+    """
+    def __init__(self, per_minute: float, burst: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """
+        amount 分を予約し、その分が使えるようになるまでの待機秒数を返す（0 なら即時）
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= min(amount, self.capacity)
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, amount: float = 1.0):
+        """
+        同期版：使えるようになるまで待つ
+        """
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CircuitBreakerOpen(Exception):
+    """
+    サーキットブレーカーが開いている（上流が停止中とみなしている）ことを表す例外
+    """
+
+
+class CircuitBreaker:
+    """
+    連続で failure_threshold 回失敗したら cooldown 秒間は呼び出しを即座に失敗させる。
+    cooldown 経過後は1件だけ試し、成功すれば通常状態に戻る。
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        """
+        呼び出し前に確認し、ブレーカーが開いていれば CircuitBreakerOpen を送出する。
+        cooldown 経過後の試しの1件なら True を返す（呼び出し側は終了時に必ず release_trial を呼ぶ）
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining = self.cooldown - (time.monotonic() - self._opened_at)
+            if remaining > 0 or self._trial_in_flight:
+                raise CircuitBreakerOpen(f"{self.name} は一時停止中です（残り {max(remaining, 0):.0f} 秒）")
+            self._trial_in_flight = True
+            return True
+
+    def release_trial(self):
+        """
+        試しの1件が成功・失敗のどちらも記録せずに終わった場合（上流と無関係なエラーなど）に、
+        次の呼び出しが改めて試せるようにする
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    print(f"[{self.name}] 連続 {self._failures} 回失敗したため {self.cooldown:.0f} 秒間呼び出しを停止します")
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
@@ -4,12 +4,19 @@ import re
 import time
 import json
 import uuid
+import tempfile
 from datetime import datetime
 # render_template を使うために必要
-from flask import Flask, request, render_template, send_from_directory, redirect, url_for, session, jsonify, abort, flash
+from flask import Flask, Request, request, render_template, send_from_directory, redirect, url_for, session, jsonify, abort, flash
 from werkzeug.utils import secure_filename
-from PIL import Image
 from background_processor import background_processor
+from image_utils import image_normalizer, check_image, UPLOAD_MEMORY_THRESHOLD
+import batch_import
+import creteNotionPerties as cnp
+from notion_api import dead_letters
+from notion_writer import notion_writer
+from lead_index import lead_index
+from handover_store import handover_store, is_valid_handover_id, HANDOVER_DIR
 # main.py 内の main 関数を process_cards としてインポート (存在すると仮定)
 try:
     from main import main as process_cards
@@ -27,13 +34,23 @@ except ImportError:
         # print("  (処理失敗(1)をシミュレート)")
         # return 1 # 異常終了
 
+class SpooledRequest(Request):
+    """
+    アップロードファイルを UPLOAD_MEMORY_THRESHOLD まではメモリ上に、超えた分は一時ファイルに保持するリクエスト
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_MEMORY_THRESHOLD, mode="w+b")
+
+
 # --- Flask アプリケーション設定 ---
 app = Flask(__name__, template_folder='html')
+app.request_class = SpooledRequest
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', os.urandom(24))
 
 # --- 定数・設定 ---
 UPLOAD_FOLDER = 'uploads'
-HANDOVER_DIR = 'handovers'
+JOB_POLL_MAX_TIMEOUT = 30.0  # ロングポーリングの最大待機秒数
+HANDOVER_LIST_MAX_LIMIT = 500  # 引き継ぎ一覧で1回に返す最大件数
 ASSIGNESS_LIST = [
     "田中康紀", "大西一誉", "阪本浩太郎", "飯田昌直", "飯田昌哉", 
     "山下一樹", "笹木将太", "神宇知一樹", "その他"
@@ -65,27 +82,6 @@ PERSONA_OPTIONS = {
 if not os.path.exists(UPLOAD_FOLDER): os.makedirs(UPLOAD_FOLDER)
 if not os.path.exists(HANDOVER_DIR): os.makedirs(HANDOVER_DIR)
 
-# --- ヘルパー関数 ---
-def convert_to_jpeg(src_path, dest_path):
-    """画像をJPEG形式に変換・リサイズして保存する"""
-    temp_path = dest_path + ".tmp"
-    try:
-        with Image.open(src_path) as img:
-            img = img.convert("RGB")
-            try:
-                img.thumbnail((512, 512), Image.Resampling.LANCZOS)
-            except AttributeError:
-                img.thumbnail((512, 512), Image.LANCZOS)
-            img.save(temp_path, format="JPEG", quality=85)
-        os.replace(temp_path, dest_path)
-        print(f"Converted image to {dest_path}")
-    except Exception as e:
-        print(f"Error converting {src_path} to JPEG: {e}")
-        if os.path.exists(temp_path):
-            try: os.remove(temp_path)
-            except OSError: pass
-        raise e
-
 # --- 静的ファイル配信ルート ---
 @app.route("/uploads/<path:filename>")
 def uploaded_file(filename):
@@ -133,7 +129,8 @@ def index():
         handover_id_to_delete = request.form.get('delete_handover_id')
         hearing_seed_files = [f for f in request.files.getlist("hearing_seed") if f and f.filename and f.filename.strip()]
 
-        temp_files_to_delete = []
+        job_id = None
+        bytes_written = 0
         business_card_final_path = None
         hearing_seed_final_paths = []
         processing_successful = False
@@ -190,11 +187,10 @@ def index():
                     filename = secure_filename(business_card_file.filename)
                     base, ext = os.path.splitext(filename)
                     timestamp = int(time.time() * 1000)
-                    temp_filepath = os.path.join(UPLOAD_FOLDER, f"{base}_{timestamp}_temp{ext}")
                     business_card_final_path = os.path.join(UPLOAD_FOLDER, f"{base}_{timestamp}.jpeg")
-                    business_card_file.save(temp_filepath)
-                    temp_files_to_delete.append(temp_filepath)
-                    convert_to_jpeg(temp_filepath, business_card_final_path)
+                    # 受信したデータを保存するだけにし、JPEGへの変換はプロセスプールで行う
+                    check_image(business_card_file)
+                    bytes_written += image_normalizer.ingest(business_card_file, business_card_final_path)
                 else:
                     raise ValueError("名刺画像が選択されていません。")
             else:
@@ -206,31 +202,31 @@ def index():
                 filename = secure_filename(file.filename)
                 base, ext = os.path.splitext(filename)
                 timestamp = int(time.time() * 1000) + i
-                temp_filepath = os.path.join(UPLOAD_FOLDER, f"hs_{base}_{timestamp}_temp{ext}")
                 final_path = os.path.join(UPLOAD_FOLDER, f"hs_{base}_{timestamp}.jpeg")
-                file.save(temp_filepath)
-                temp_files_to_delete.append(temp_filepath)
                 try:
-                    convert_to_jpeg(temp_filepath, final_path)
+                    bytes_written += image_normalizer.ingest(file, final_path)
                     hearing_seed_final_paths.append(final_path)
                 except Exception as conv_e:
-                    print(f"ヒアリングシート画像 '{filename}' の変換エラー: {conv_e}")
+                    print(f"ヒアリングシート画像 '{filename}' の保存エラー: {conv_e}")
+
+            if bytes_written:
+                print(f"[アップロード] 画像 {len(hearing_seed_final_paths) + (1 if business_card_final_path else 0)} 件 / 書き込み {bytes_written} バイト")
 
             # 6. バックグラウンド処理の開始
             business_card_abs_path = os.path.abspath(business_card_final_path) if business_card_final_path else None
             hearing_seed_abs_paths = [os.path.abspath(p) for p in hearing_seed_final_paths]
             
             # バックグラウンド処理を開始
-            background_processor.start_background_process(
+            job_id = background_processor.start_background_process(
                 business_card_abs_path, hearing_seed_abs_paths, lead_date, context
             )
             
-            print("--- Background processing started ---")
+            print(f"--- Background processing started (job: {job_id}) ---")
             processing_successful = True
             if input_method == 'manual':
-                context['message'] = "手入力データで処理をバックグラウンドで開始しました。結果はコンソールで確認できます。"
+                context['message'] = "手入力データで処理をバックグラウンドで開始しました。進捗は下に表示されます。"
             else:
-                context['message'] = "名刺画像で処理をバックグラウンドで開始しました。結果はコンソールで確認できます。"
+                context['message'] = "名刺画像で処理をバックグラウンドで開始しました。進捗は下に表示されます。"
             context['success'] = "1"
 
         except ValueError as ve:
@@ -250,36 +246,26 @@ def index():
             print(f"!!! Processing Error: {e} !!!")
             import traceback
             traceback.print_exc()
-            
-        finally:
-            # 後処理: 一時ファイルの削除
-            for temp_file in temp_files_to_delete:
-                if os.path.exists(temp_file):
-                    try:
-                        os.remove(temp_file)
-                        print(f"Deleted temp file: {temp_file}")
-                    except OSError as e:
-                        print(f"Error deleting temp file {temp_file}: {e}")
 
         # 8. 最終的な処理分岐 (成功ならリダイレクト、失敗なら再レンダリング)
         if processing_successful:
             # 成功時: 引き継ぎファイル削除
             if handover_id_to_delete:
                  # (ファイル削除ロジック)
-                if handover_id_to_delete and '..' not in handover_id_to_delete and '/' not in handover_id_to_delete and '\\' not in handover_id_to_delete:
-                    filepath_to_delete = os.path.join(HANDOVER_DIR, f"{handover_id_to_delete}.json")
+                if is_valid_handover_id(handover_id_to_delete):
                     try:
-                        if os.path.exists(filepath_to_delete):
-                            os.remove(filepath_to_delete)
-                            print(f"Deleted handover file: {filepath_to_delete}")
-                        else:
-                            print(f"Handover file not found for deletion: {filepath_to_delete}")
+                        if not handover_store.delete(handover_id_to_delete):
+                            print(f"Handover file not found for deletion: {handover_id_to_delete}")
                     except OSError as e:
-                        print(f"Error deleting handover file {filepath_to_delete}: {e}")
+                        print(f"Error deleting handover file {handover_id_to_delete}: {e}")
                 else:
                     print(f"Invalid handover ID format received for deletion: '{handover_id_to_delete}'")
+            # API クライアントにはジョブIDを JSON で返す
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({'status': 'success', 'job_id': job_id, 'message': context['message'],
+                                'bytes_written': bytes_written}), 202
             # 成功時はメインページにリダイレクト（PRGパターン）
-            return redirect(url_for("index", message=context['message'], success=context['success']))
+            return redirect(url_for("index", message=context['message'], success=context['success'], job_id=job_id))
         
         else:
             # ★★★ 失敗時: 入力値を保持してフォームを再レンダリング ★★★
@@ -292,6 +278,7 @@ def index():
         context = {
             'message': request.args.get("message", ""),
             'success': request.args.get("success", "0"),
+            'job_id': request.args.get("job_id", ""),
             'tantosha_value': session.get('last_tantosha', ''),
             'assignees_list': ASSIGNESS_LIST,
             'proposal_plan_list': PLAN_LIST,
@@ -327,77 +314,45 @@ def save_handover():
     if not data.get('handover_source_tantosha'): 
         return jsonify({'status': 'error', 'message': '担当者が選択されていません'}), 400
     
-    handover_id = str(uuid.uuid4())
-    data['handover_timestamp'] = datetime.now().isoformat()
-    
-    filename = f"{handover_id}.json"
-    filepath = os.path.join(HANDOVER_DIR, filename)
-    
-    if os.path.dirname(os.path.abspath(filepath)) != os.path.abspath(HANDOVER_DIR): return jsonify({'status': 'error', 'message': '内部エラーが発生しました'}), 500
-    
     try:
-        with open(filepath, 'w', encoding='utf-8') as f: 
-            json.dump(data, f, ensure_ascii=False, indent=4)
-            
-        print(f"Saved handover data to: {filepath}")
-        
+        handover_id = handover_store.save(data)
         return jsonify({'status': 'success', 'id': handover_id})
     
     except IOError as e: 
-        print(f"Error saving handover file {filepath}: {e}"); 
+        print(f"Error saving handover file: {e}"); 
         return jsonify({'status': 'error', 'message': 'データの保存に失敗しました'}), 500
     
     except Exception as e: 
-        print(f"Unexpected error saving handover file {filepath}: {e}"); 
+        print(f"Unexpected error saving handover file: {e}"); 
         return jsonify({'status': 'error', 'message': '予期せぬエラーが発生しました'}), 500
 
 
 # --- 引き継ぎデータのリスト取得 API エンドポイント ---
 @app.route('/api/list_handovers', methods=['GET'])
 def list_handovers():
-
-    handovers = []
+    """
+    引き継ぎデータを新しい順に返す（?limit=, ?offset= でページング。総件数は X-Total-Count ヘッダー）
+    """
+    limit = max(1, min(request.args.get('limit', 100, type=int), HANDOVER_LIST_MAX_LIMIT))
+    offset = max(0, request.args.get('offset', 0, type=int))
     try:
-        for filename in os.listdir(HANDOVER_DIR):
-            if filename.endswith(".json"):
-                try:
-                    uuid.UUID(filename[:-5], version=4)
-                except ValueError: 
-                    continue
-                
-                filepath = os.path.join(HANDOVER_DIR, filename)
-                
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f: data = json.load(f)
-                    handovers.append({'id': filename[:-5],'source_tantosha': data.get('handover_source_tantosha', '不明'),'timestamp': data.get('handover_timestamp')})
-                
-                except Exception as e: print(f"Err reading {filename}: {e}")
-        handovers.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        return jsonify(handovers)
+        response = jsonify(handover_store.list(limit=limit, offset=offset))
+        response.headers['X-Total-Count'] = str(handover_store.count())
+        return response
     
-    except FileNotFoundError: return jsonify([])
     except Exception as e: print(f"Error listing handovers: {e}"); return jsonify({'status': 'error', 'message': 'リストの取得に失敗しました'}), 500
 
 
 # --- 引き継ぎデータの取得 API エンドポイント ---
 @app.route('/api/get_handover/<string:handover_id>', methods=['GET'])
 def get_handover(handover_id):
-    try: 
-        uuid.UUID(handover_id, version=4)
-    except ValueError:
+    if not is_valid_handover_id(handover_id):
         return jsonify({'status': 'error', 'message': '無効なID形式です'}), 400
     
-    filename = f"{handover_id}.json"
-    filepath = os.path.join(HANDOVER_DIR, filename)
-    
-    if os.path.dirname(os.path.abspath(filepath)) != os.path.abspath(HANDOVER_DIR): 
-        abort(400)
-        
-    if not os.path.exists(filepath): 
-        return jsonify({'status': 'error', 'message': '指定された引き継ぎデータが見つかりません'}), 404
-    
     try:
-        with open(filepath, 'r', encoding='utf-8') as f: data = json.load(f)
+        data = handover_store.get(handover_id)
+        if data is None: 
+            return jsonify({'status': 'error', 'message': '指定された引き継ぎデータが見つかりません'}), 404
         return jsonify(data)
     
     except json.JSONDecodeError: 
@@ -412,57 +367,157 @@ def get_handover(handover_id):
 @app.route('/api/delete_handover/<string:handover_id>', methods=['DELETE'])
 def delete_handover_api(handover_id):
     """
-    指定されたIDの引き継ぎデータ（JSONファイル）を削除するAPIエンドポイント。
+    指定されたIDの引き継ぎデータ（JSONファイルと一覧の索引）を削除するAPIエンドポイント。
     JavaScriptから直接呼び出されることを想定。
     """
     print(f"[API] Received DELETE request for handover ID: {handover_id}") # ログ
 
-    # 1. ID形式 (UUID v4) の検証
-    try:
-        uuid.UUID(handover_id, version=4)
-    except ValueError:
+    # 1. ID形式 (UUID v4) の検証（ファイル名に使うため、ディレクトリトラバーサルもここで防ぐ）
+    if not is_valid_handover_id(handover_id):
         print(f"[API Error] Invalid UUID format for deletion: {handover_id}")
         return jsonify({'status': 'error', 'message': '無効な引き継ぎID形式です。'}), 400 # Bad Request
 
-    # 2. ファイルパスの構築と安全性の確認
-    filename = f"{handover_id}.json"
-    filepath = os.path.join(HANDOVER_DIR, filename)
-
-    # ディレクトリトラバーサル防止 (save/get と同じチェック)
-    if os.path.dirname(os.path.abspath(filepath)) != os.path.abspath(HANDOVER_DIR):
-        print(f"[API Security Error] Path traversal attempt detected for ID: {handover_id}")
-        # abort(400) の代わりにJSONレスポンスを返す
-        return jsonify({'status': 'error', 'message': '不正な引き継ぎIDです。'}), 400 # Bad Request
-
-    print(f"[API] Attempting to delete file: {filepath}") # ログ
-
-    # 3. ファイルの存在確認と削除処理
+    # 2. 削除処理
     try:
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"[API] Successfully deleted handover file: {filepath}") # ログ
+        if handover_store.delete(handover_id):
+            print(f"[API] Successfully deleted handover: {handover_id}") # ログ
             # 成功レスポンス
             return jsonify({'status': 'success', 'message': '引き継ぎデータを削除しました。'}), 200
         else:
             # ファイルが見つからない場合
-            print(f"[API Warn] Handover file not found for deletion: {filepath}") # ログ
+            print(f"[API Warn] Handover not found for deletion: {handover_id}") # ログ
             return jsonify({'status': 'error', 'message': '指定された引き継ぎデータが見つかりません。'}), 404 # Not Found
 
     except OSError as e:
         # ファイル削除時のOSエラー（例: パーミッション不足）
-        print(f"[API Error] OSError deleting file {filepath}: {e}") # エラーログ
+        print(f"[API Error] OSError deleting handover {handover_id}: {e}") # エラーログ
         return jsonify({'status': 'error', 'message': f'ファイルの削除に失敗しました: {e.strerror}'}), 500 # Internal Server Error
     except Exception as e:
         # その他の予期せぬエラー
-        print(f"[API Error] Unexpected error deleting file {filepath}: {e}") # エラーログ
+        print(f"[API Error] Unexpected error deleting handover {handover_id}: {e}") # エラーログ
         import traceback
         traceback.print_exc() # 詳細なトレースバックを出力
         return jsonify({'status': 'error', 'message': '予期せぬエラーが発生し、削除に失敗しました。'}), 500 # Internal Server Error
     
     
+# --- ジョブ状態 API エンドポイント ---
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """
+    バックグラウンド処理のジョブ一覧を新しい順に返す（?status=failed などで絞り込み可）
+    """
+    status = request.args.get('status') or None
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify(background_processor.list_jobs(status=status, limit=max(1, min(limit, 500))))
+
+
+@app.route('/api/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    ジョブの状態を返す。?since=<updated_at> を付けると、状態が変わるまで最大 ?timeout 秒待ってから返す（ロングポーリング）
+    """
+    try:
+        uuid.UUID(job_id, version=4)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': '無効なジョブID形式です'}), 400
+
+    since = request.args.get('since')
+    timeout = max(0.0, min(request.args.get('timeout', 25.0, type=float), JOB_POLL_MAX_TIMEOUT))
+    job = background_processor.wait_for_job(job_id, since=since, timeout=timeout)
+    if job is None:
+        return jsonify({'status': 'error', 'message': '指定されたジョブが見つかりません'}), 404
+    return jsonify(job)
+
+
+# --- Notion 書き込みサービスの状態 API エンドポイント ---
+@app.route('/api/notion/metrics', methods=['GET'])
+def notion_writer_metrics():
+    """
+    Notion 書き込みキューの深さと書き込み時間を返す
+    """
+    return jsonify(notion_writer.metrics())
+
+
+# --- Notion に送れなかったリードの API エンドポイント ---
+@app.route('/api/dead_letters', methods=['GET'])
+def list_dead_letters():
+    """
+    再試行しても Notion に登録できなかったリードの一覧を返す
+    """
+    entries = dead_letters.list()
+    return jsonify([{'id': e['id'], 'page_id': e.get('page_id'), 'ambiguous': bool(e.get('ambiguous')), 'error': e.get('error'), 'created_at': e.get('created_at')} for e in entries])
+
+
+@app.route('/api/dead_letters/replay', methods=['POST'])
+def replay_dead_letters():
+    """
+    保存済みのリードを Notion に再送する。
+    ページ作成済みか分からないリードは、include_ambiguous=true を指定したときだけ再送する
+    """
+    include_ambiguous = request.values.get('include_ambiguous', '').lower() in ['true', '1', 't']
+    succeeded, failed, held = cnp.replay_dead_letters(include_ambiguous=include_ambiguous)
+    return jsonify({'status': 'success', 'succeeded': succeeded, 'failed': failed, 'held': held})
+
+
+# --- 名刺画像の一括取り込み API エンドポイント ---
+@app.route('/api/batch', methods=['POST'])
+def start_batch_import():
+    """
+    zip（name="archive"）またはサーバー上のフォルダ（name="folder"）の名刺画像を一括で取り込む。
+    フォルダは BATCH_IMPORT_ROOT 配下の相対パスのみ指定できる
+    """
+    tantosha = request.form.get('tantosha', '').strip()
+    if not tantosha:
+        return jsonify({'status': 'error', 'message': '担当者が選択されていません'}), 400
+
+    lead_date = request.form.get('lead_date', '').strip() or None
+    if lead_date and not re.match(r"^\d{4}/\d{1,2}/\d{1,2}$", lead_date):
+        return jsonify({'status': 'error', 'message': '日付はYYYY/M/D 形式で入力してください'}), 400
+
+    archive = request.files.get('archive')
+    folder = request.form.get('folder', '').strip()
+    if archive and archive.filename:
+        if not archive.filename.lower().endswith('.zip'):
+            return jsonify({'status': 'error', 'message': 'zipファイルを指定してください'}), 400
+        os.makedirs(batch_import.BATCH_DIR, exist_ok=True)
+        source = os.path.join(batch_import.BATCH_DIR, f"upload_{uuid.uuid4().hex}.zip")
+        archive.save(source)
+    elif folder:
+        source = batch_import.resolve_import_folder(folder)
+        if source is None:
+            return jsonify({'status': 'error', 'message': '指定できないフォルダです'}), 400
+    else:
+        return jsonify({'status': 'error', 'message': 'zipファイルまたはフォルダを指定してください'}), 400
+
+    context = batch_import.build_batch_context(tantosha, request.form.get('proposal_plan', '').strip())
+    batch_id = batch_import.start_batch(source, context, lead_date)
+    print(f"[API] Started batch import {batch_id} from {source}")
+    return jsonify({'status': 'success', 'batch_id': batch_id}), 202
+
+
+@app.route('/api/batch/<string:batch_id>', methods=['GET'])
+def get_batch_import(batch_id):
+    """
+    一括取り込みの進捗を返す。?since=<updated_at> でロングポーリング
+    """
+    batch = batch_import.get_batch(batch_id)
+    if batch is None:
+        return jsonify({'status': 'error', 'message': '指定されたバッチが見つかりません'}), 404
+    since = request.args.get('since')
+    timeout = max(0.0, min(request.args.get('timeout', 25.0, type=float), JOB_POLL_MAX_TIMEOUT))
+    return jsonify(batch.wait_for_update(since=since, timeout=timeout))
+
+
 # --- サーバー起動 ---
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5001))
     debug_mode = os.environ.get("FLASK_DEBUG", "False").lower() in ["true", "1", "t"]
     print(f"Starting Flask app on port {port} with debug mode: {debug_mode}")
+    # リローダーの親プロセスではワーカーを起動しない（ジョブの二重処理防止）
+    if not debug_mode or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        background_processor.start()
+        # 重複判定用のリード索引を Notion と差分同期する（前回以降に編集されたページのみ）
+        lead_index.start_sync()
+        # 保持期間を過ぎた引き継ぎデータを定期的に削除する
+        handover_store.start_sweeper()
     app.run(host="0.0.0.0", port=port, debug=debug_mode)
\ No newline at end of file
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src", "notion_sever"))
+
+if not os.path.exists(os.path.join(ROOT, "config.ini")):
+    pytest.skip("config.ini がないためスキップします", allow_module_level=True)
+
+batch_import = pytest.importorskip("batch_import")
+
+
+@pytest.fixture
+def import_root(tmp_path, monkeypatch):
+    (tmp_path / "scans").mkdir()
+    monkeypatch.setattr(batch_import, "BATCH_IMPORT_ROOT", str(tmp_path))
+    return tmp_path
+
+
+def test_resolve_import_folder_inside_root(import_root):
+    assert batch_import.resolve_import_folder("scans") == os.path.realpath(import_root / "scans")
+
+
+def test_resolve_import_folder_rejects_outside_root(import_root):
+    assert batch_import.resolve_import_folder("../") is None
+    assert batch_import.resolve_import_folder("/etc") is None
+    assert batch_import.resolve_import_folder("missing") is None
+
+
+def test_resolve_import_folder_disabled_without_root(monkeypatch):
+    monkeypatch.setattr(batch_import, "BATCH_IMPORT_ROOT", "")
+    assert batch_import.resolve_import_folder("scans") is None
+
+
+def test_api_batch_folder(import_root, monkeypatch):
+    sever = pytest.importorskip("sever")
+    started = []
+    monkeypatch.setattr(batch_import, "start_batch",
+                        lambda source, context, lead_date: started.append(source) or "batch-1")
+    client = sever.app.test_client()
+
+    response = client.post('/api/batch', data={'tantosha': '山下一樹', 'folder': 'scans'})
+    assert response.status_code == 202
+    assert response.get_json()['batch_id'] == "batch-1"
+    assert started == [os.path.realpath(import_root / "scans")]
+
+    response = client.post('/api/batch', data={'tantosha': '山下一樹', 'folder': '../'})
+    assert response.status_code == 400
+    assert len(started) == 1